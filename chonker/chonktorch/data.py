@@ -1,3 +1,6 @@
+import json
+
+import numpy as np
 import torch
 import torch.nn as nn
 from torch.utils.data import Dataset
@@ -16,6 +19,13 @@ class VariableLengthDataset(Dataset):
     a set number of sequences, or as an approximate number of tokens/timesteps
     per batch.
 
+    Only the batch boundaries are computed at initialization; each batch is
+    collated into a tensor when it is accessed. Wrapping the Dataset in
+    ``DataLoader(dataset, batch_size=None, num_workers=N)`` therefore
+    parallelizes collation across worker processes. To copy batches to the GPU
+    asynchronously, pass ``pin_memory=True`` to the ``DataLoader``, which pins
+    them in the main process.
+
     Args:
         data: A list of numerically-embedded sequences
         batch_size: Batch size, either by number of sequences or number of
@@ -27,8 +37,14 @@ class VariableLengthDataset(Dataset):
             batch will consist of sequences that add up to no more than
             ``batch_size`` tokens total when padded. Note under this option,
             batches will contain different number of sequences, but be about
-            the same size in terms of total number of elements. Default:
-            ``sequences``
+            the same size in terms of total number of elements. If
+            ``packed``, sequences are packed without padding into batches of
+            no more than ``batch_size`` tokens using Best-Fit Decreasing bin
+            packing, and each batch is a flat tensor of the concatenated
+            sequences (see ``pack_collate``), as in the ``packed`` output of
+            ``pad_and_batch``. This is unrelated to
+            ``return_packed_sequence``. ``max_padding`` does not apply under
+            this option. Default: ``sequences``
         gradient_accumulation (optional): number of gradient accumulation steps
             over batches. Used to define the effective size of full batches when
             dropping incomplete the incomplete final batch. See ``drop_final``.
@@ -51,6 +67,17 @@ class VariableLengthDataset(Dataset):
             be dropped. This may be useful if batching is being done by
             sequences and only complete batch sizes are acceptable (i.e.
             ``drop_final`` is ``True``). Default: ``soft_drop``
+        dtype (optional): The dtype in which to store and collate the
+            sequences, e.g. ``torch.int16`` or ``torch.int32`` for token IDs
+            from a small enough vocabulary, reducing memory and host-to-device
+            bandwidth. A ``ValueError`` is raised if any value (or the
+            ``pad_value``) cannot be represented in an integer ``dtype``. If
+            ``None``, the dtype of the input data is kept. Default: ``None``
+        return_packed_sequence (optional): Whether padded batches are returned
+            as a ``torch.nn.utils.rnn.PackedSequence`` instead of a padded
+            tensor, so that RNNs can skip computation over the padding. This
+            is unrelated to ``batch_by='packed'``, whose batches are flat
+            concatenations of the sequences. Default: ``False``
     """
     def __init__(
         self,
@@ -61,112 +88,291 @@ class VariableLengthDataset(Dataset):
         gradient_accumulation: int = 1,
         drop_final: bool = False,
         max_padding: int = None,
-        max_pad_strategy: str = 'soft_drop'
+        max_pad_strategy: str = 'soft_drop',
+        dtype: torch.dtype = None,
+        return_packed_sequence: bool = False
     ) -> Dataset:
 
         self.batch_size = batch_size
+        self.batch_by = batch_by
         self.pad_value = pad_value
         self.max_padding = max_padding
         self.max_pad_strategy = max_pad_strategy
+        self.dtype = dtype
+        self.return_packed_sequence = return_packed_sequence
 
         # Make sure that all string parameters have recognized values
-        if batch_by not in ['sequences', 'tokens']:
-            raise ValueError(f'Batch-by option {self.batch_by} is not valid')
+        if batch_by not in ['sequences', 'tokens', 'packed']:
+            raise ValueError(f'Batch-by option {batch_by} is not valid')
         if max_pad_strategy not in ['split', 'soft_drop', 'hard_drop']:
             raise ValueError(
                 f'Max pad strategy {self.max_pad_strategy} is not valid'
             )
 
+        # Convert the sequences into a single flat tensor up front, so that
+        # batches are collated from views of it instead of converting each
+        # sequence separately
+        flat, offsets = ctf.flatten_sequences(data)
+        self._batch_flat(flat, offsets, gradient_accumulation, drop_final)
+
+    def _batch_flat(self, flat, offsets, gradient_accumulation, drop_final):
+        """
+        Sort and batch the sequences stored in a flat tensor, where sequence
+        `i` is `flat[offsets[i]:offsets[i + 1]]`
+        """
+        batch_size = self.batch_size
+        batch_by = self.batch_by
+        max_padding = self.max_padding
+
         # If batches are formed by a set number of sequences and drop_final is
         # True, calculate the total number of full batches and drop leftover
         # sequences
+        offsets = np.asarray(offsets, dtype=np.int64)
         if batch_by == 'sequences' and drop_final:
             full_batch_size = batch_size * gradient_accumulation
-            num_full_batches = len(data) // full_batch_size
-            data = data[:num_full_batches * full_batch_size]
+            num_full_batches = (len(offsets) - 1) // full_batch_size
+            offsets = offsets[:num_full_batches * full_batch_size + 1]
 
         # Sort the data sequences in descending order of length for efficiency
         # (save permutations used to sort and unsort sequences as object
-        # attributes)
-        lengths = [len(line) for line in data]
+        # attributes), gathering them into sorted order in a new flat tensor
+        lengths = np.diff(offsets)
         self.sort_pmt, self.unsort_pmt = ctf.sort_unsort_pmts(
             lengths, descending=True
         )
-        data = list(zip(data, lengths))
-        data = [data[i] for i in self.sort_pmt]
-
-        # Form the sorted data into batches, either by number of sequences or
-        # approximate number of tokens/timesteps. Collate all batches into
-        # tensors using the pad_collate function
-        self.total_num_instances = len(data)
-        batched_data = []
-        current_index = 0
-        while current_index < self.total_num_instances:
+        lengths = lengths[self.sort_pmt]
+        sorted_offsets = np.concatenate([[0], np.cumsum(lengths)])
+        gather_index = np.arange(sorted_offsets[-1]) + np.repeat(
+            offsets[:-1][self.sort_pmt] - sorted_offsets[:-1], lengths
+        )
+        flat = flat[torch.from_numpy(gather_index)]
+
+        # Optionally store the sequences in a different (usually narrower)
+        # dtype, making sure all integer values can be represented in it
+        if self.dtype is not None:
+            if not self.dtype.is_floating_point:
+                info = torch.iinfo(self.dtype)
+                values = [self.pad_value]
+                if flat.numel() > 0:
+                    values += [flat.min().item(), flat.max().item()]
+                if min(values) < info.min or max(values) > info.max:
+                    raise ValueError(
+                        f'Sequence values cannot be represented as {self.dtype}'
+                    )
+            flat = flat.to(self.dtype)
+        self.flat = flat
+        self.offsets = sorted_offsets.astype(np.int64)
+
+        # Form the sorted data into batches, either by number of sequences,
+        # approximate number of tokens/timesteps, or packed token capacity.
+        # Each batch is stored as the indices of its sequences
+        self.total_num_instances = len(lengths)
+        if batch_by == 'packed':
+            batched_data = ctf.pack_bins(lengths.tolist(), batch_size)
+        else:
+            # Compute the end of the batch that would start at each sequence
+            # all at once, so that forming the batches only needs to step
+            # through the batch boundaries
+            starts = np.arange(self.total_num_instances)
             if batch_by == 'sequences':
-                next_index = current_index + batch_size
+                next_indices = starts + batch_size
             elif batch_by == 'tokens':
-                current_length = data[current_index][1]
-                seqs_per_batch = max(batch_size // current_length, 1)
-                next_index = current_index + seqs_per_batch
-
-            next_index = min(self.total_num_instances, next_index)
+                seqs_per_batch = batch_size // np.maximum(lengths, 1)
+                next_indices = starts + np.maximum(seqs_per_batch, 1)
+            next_indices = np.minimum(next_indices, self.total_num_instances)
 
             # Some combinations of padding and attention patterns in pytorch
-            # cause an error during forward passes, so it is sometimes necessary
-            # to restrict the number of pad tokens allowed at the end of a
-            # sequence
+            # cause an error during forward passes, so it is sometimes
+            # necessary to restrict the number of pad tokens allowed at the end
+            # of a sequence. Since the lengths are sorted, the first sequence
+            # that would need too much padding after each sequence can be
+            # found by binary search
             if self.max_padding:
-                legal_next_index = current_index + 1
-                current_length = data[current_index][1]
-                for i in range(current_index + 1, next_index):
-                    length_difference = (current_length - data[i][1])
-                    if length_difference > max_padding:
-                        break
-                    else:
-                        legal_next_index = i + 1
-                if (legal_next_index < next_index):
-                    if self.max_pad_strategy == 'hard_drop':
-                        current_index = next_index
-                        continue
-                    elif self.max_pad_strategy == 'soft_drop':
-                        current_index = legal_next_index
-                        continue
-                next_index = legal_next_index
-
-            new_batch = self.pad_collate(data[current_index:next_index])
-            batched_data.append(new_batch)
-            current_index = next_index
+                legal_next_indices = np.minimum(
+                    np.searchsorted(
+                        -lengths, max_padding - lengths, side='right'
+                    ),
+                    next_indices
+                ).tolist()
+            next_indices = next_indices.tolist()
+
+            batched_data = []
+            current_index = 0
+            while current_index < self.total_num_instances:
+                next_index = next_indices[current_index]
+                if self.max_padding:
+                    legal_next_index = legal_next_indices[current_index]
+                    if (legal_next_index < next_index):
+                        if self.max_pad_strategy == 'hard_drop':
+                            current_index = next_index
+                            continue
+                        elif self.max_pad_strategy == 'soft_drop':
+                            current_index = legal_next_index
+                            continue
+                    next_index = legal_next_index
+
+                batched_data.append(range(current_index, next_index))
+                current_index = next_index
 
         # If batches are formed by number of tokens and drop_final is True,
         # calculate the total number of full batches and drop leftover non-full
         # batches
-        if batch_by == 'tokens' and drop_final:
+        if batch_by in ['tokens', 'packed'] and drop_final:
             num_full_batches = len(batched_data) // gradient_accumulation
             num_batches = num_full_batches * gradient_accumulation
             trimmed_instances = sum(
-                [len(batch[1]) for batch in batched_data[num_batches:]]
+                [len(batch) for batch in batched_data[num_batches:]]
             )
             batched_data = batched_data[:num_batches]
             self.total_num_instances -= trimmed_instances
 
-        # Data is a list of collated batches (tensor, lengths)
-        self.data = batched_data
+        # Batches is a list of the indices into the sorted sequences in each
+        # batch
+        self.batches = batched_data
+
+    @classmethod
+    def from_flat(
+        cls,
+        flat,
+        offsets,
+        batch_size: int,
+        pad_value: float,
+        gradient_accumulation: int = 1,
+        drop_final: bool = False,
+        **kwargs
+    ):
+        """
+        Initialize the Dataset from sequences already stored in a single flat
+        NumPy array or tensor, where sequence `i` is
+        `flat[offsets[i]:offsets[i + 1]]`. This avoids holding the corpus as
+        lists of Python numbers. Other arguments are as in the constructor
+        """
+        dataset = cls(
+            [],
+            batch_size,
+            pad_value,
+            gradient_accumulation=gradient_accumulation,
+            drop_final=drop_final,
+            **kwargs
+        )
+        dataset._batch_flat(
+            torch.as_tensor(flat), offsets, gradient_accumulation, drop_final
+        )
+        return dataset
 
     def __len__(self):
-        return len(self.data)
+        return len(self.batches)
 
     def __getitem__(self, index):
-        return self.data[index]
+        """
+        Collate the batch at the given index into (tensor, lengths), or (tensor,
+        lengths, cu_seqlens) if batched by ``packed``
+        """
+        # Sequences are sliced out of the flat tensor only when their batch is
+        # accessed, so that no per-sequence objects are kept
+        flat = self.flat
+        indices = np.asarray(self.batches[index], dtype=np.int64)
+        starts = self.offsets[indices].tolist()
+        ends = self.offsets[indices + 1].tolist()
+        batch = [
+            (flat[start:end], end - start) for start, end in zip(starts, ends)
+        ]
+        if self.batch_by == 'packed':
+            return self.pack_collate(batch)
+        return self.pad_collate(batch)
 
     def pad_collate(self, batch):
         """
         Collate and pad a list of (sequence, length) pairs into a contiguous
         tensor and list of lengths
         """
-        sequences = [torch.tensor(x[0]) for x in batch]
+        sequences = [torch.as_tensor(x[0]) for x in batch]
         lengths = [x[1] for x in batch]
-        tensor = nn.utils.rnn.pad_sequence(
-            sequences, padding_value=self.pad_value
+
+        # Allocate the padded (max_len, batch_size) buffer once and copy each
+        # sequence into its column, rather than padding each sequence
+        # separately. The buffer is contiguous by construction
+        tensor = torch.full(
+            (max(lengths), len(sequences)) + sequences[0].shape[1:],
+            self.pad_value,
+            dtype=sequences[0].dtype
         )
-        tensor = tensor.contiguous()
+        for i, sequence in enumerate(sequences):
+            tensor[:lengths[i], i].copy_(sequence)
+
+        # Sequences within a batch are already sorted by descending length, as
+        # packing requires
+        if self.return_packed_sequence:
+            tensor = nn.utils.rnn.pack_padded_sequence(
+                tensor, torch.tensor(lengths), enforce_sorted=True
+            )
         return (tensor, lengths)
+
+    def pack_collate(self, batch):
+        """
+        Collate a list of (sequence, length) pairs into a single flat tensor of
+        the concatenated sequences, the list of lengths, and the cumulative
+        sequence offsets (``cu_seqlens``) that mark the sequence boundaries
+        """
+        sequences = [torch.as_tensor(x[0]) for x in batch]
+        lengths = [x[1] for x in batch]
+        tensor = torch.cat(sequences)
+        cu_seqlens = torch.zeros(len(lengths) + 1, dtype=torch.int32)
+        cu_seqlens[1:] = torch.cumsum(torch.tensor(lengths), dim=0)
+        return (tensor, lengths, cu_seqlens)
+
+    def save(self, out_file):
+        """
+        Save the sorted and batched Dataset, so that it can be reloaded without
+        re-sorting and re-batching the sequences
+
+        The flat tensor of sorted sequences is saved as a NumPy array at
+        `{out_file}.npy`, and the batches, permutations, and settings are
+        saved to `{out_file}_batches.json`
+        """
+        np.save(f'{out_file}.npy', self.flat.numpy())
+        save_dict = {
+            'batch_size': self.batch_size,
+            'batch_by': self.batch_by,
+            'pad_value': self.pad_value,
+            'max_padding': self.max_padding,
+            'max_pad_strategy': self.max_pad_strategy,
+            'total_num_instances': self.total_num_instances,
+            'offsets': self.offsets.tolist(),
+            'sort_pmt': list(self.sort_pmt),
+            'unsort_pmt': list(self.unsort_pmt),
+            'batches': [list(batch) for batch in self.batches]
+        }
+        with open(f'{out_file}_batches.json', 'w') as f:
+            json.dump(save_dict, f)
+
+    def load(self, in_file):
+        """
+        Load a Dataset saved with `save`, replacing the current contents
+
+        The flat tensor of sequences is memory-mapped rather than read into
+        memory, so batches are only read from disk as they are accessed
+        """
+        with open(f'{in_file}_batches.json', 'r') as f:
+            save_dict = json.load(f)
+        self.batch_size = save_dict['batch_size']
+        self.batch_by = save_dict['batch_by']
+        self.pad_value = save_dict['pad_value']
+        self.max_padding = save_dict['max_padding']
+        self.max_pad_strategy = save_dict['max_pad_strategy']
+        self.total_num_instances = save_dict['total_num_instances']
+        self.sort_pmt = save_dict['sort_pmt']
+        self.unsort_pmt = save_dict['unsort_pmt']
+        self.batches = save_dict['batches']
+        # Copy-on-write mode gives a writeable array, which torch requires to
+        # share its memory without copying
+        self.flat = torch.from_numpy(
+            np.load(f'{in_file}.npy', mmap_mode='c')
+        )
+        self.offsets = np.asarray(save_dict['offsets'], dtype=np.int64)
+
+    @classmethod
+    def from_saved(cls, in_file, **kwargs):
+        dataset = cls([], 1, 0, **kwargs)
+        dataset.load(in_file)
+        return dataset
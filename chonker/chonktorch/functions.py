@@ -1,5 +1,7 @@
 """A module of functions for data pipelines using PyTorch"""
 
+import heapq
+import itertools
 import json
 import math
 import random
@@ -7,7 +9,6 @@ from logging import Logger
 
 import torch
 import numpy as np
-import torch.nn as nn
 
 from ..wrangle import Vocab
 
@@ -18,13 +19,28 @@ def sort_unsort_pmts(lst, descending=False):
     necessary to restore it to its original order
     """
 
-    sort_zip = list(zip(lst, [x for x in range(len(lst))]))
-    sort_zip.sort(key=lambda x: x[0], reverse=descending)
-    sort_pmt = [x[1] for x in sort_zip]
-    unsort_zip = list(zip(sort_pmt, [x for x in range(len(sort_pmt))]))
-    unsort_zip.sort(key=lambda x: x[0])
-    unsort_pmt = [x[1] for x in unsort_zip]
-    return sort_pmt, unsort_pmt
+    arr = np.asarray(lst)
+    if arr.ndim != 1:
+        # Items that NumPy cannot hold as a flat array (e.g. tuples) are sorted
+        # in Python, which is also stable in reverse
+        sort_pmt = np.array(
+            sorted(
+                range(len(lst)), key=lambda i: lst[i], reverse=descending
+            ),
+            dtype=np.int64
+        )
+    elif descending:
+        # Sort the reversed values stably in ascending order and reverse the
+        # result, which keeps ties in their original order like a stable
+        # reverse sort. Unlike negating the values, this works for unsigned
+        # and non-numeric values
+        sort_pmt = arr.size - 1 - np.argsort(arr[::-1], kind='stable')[::-1]
+    else:
+        sort_pmt = np.argsort(arr, kind='stable')
+    # The inverse of a permutation can be computed by a single scatter
+    unsort_pmt = np.empty_like(sort_pmt)
+    unsort_pmt[sort_pmt] = np.arange(sort_pmt.size)
+    return sort_pmt.tolist(), unsort_pmt.tolist()
 
 
 def shuffle_unshuffle_pmts(length):
@@ -33,12 +49,105 @@ def shuffle_unshuffle_pmts(length):
     permutation necessary to restore it to its original order
     """
 
-    shuffle_pmt = [x for x in range(length)]
+    shuffle_pmt = list(range(length))
     random.shuffle(shuffle_pmt)
-    unshuffle_zip = list(zip(shuffle_pmt, [x for x in range(length)]))
-    unshuffle_zip.sort(key=lambda x: x[0])
-    unshuffle_pmt = [x[1] for x in unshuffle_zip]
-    return shuffle_pmt, unshuffle_pmt
+    unshuffle_pmt = np.empty(length, dtype=np.int64)
+    unshuffle_pmt[shuffle_pmt] = np.arange(length)
+    return shuffle_pmt, unshuffle_pmt.tolist()
+
+
+def flatten_sequences(sequences):
+    """
+    Convert a list of variable-length sequences into a single flat tensor in
+    one pass, returning it along with the sequence offsets, such that sequence
+    `i` is the view `flat[offsets[i]:offsets[i + 1]]`
+
+    Sequences given as tensors or NumPy arrays (possibly with further feature
+    dimensions) are concatenated along their first dimension; nested Python
+    lists are converted in a single call
+    """
+
+    lengths = np.fromiter(
+        map(len, sequences), dtype=np.int64, count=len(sequences)
+    )
+    offsets = np.zeros(len(sequences) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    if any(isinstance(s, (torch.Tensor, np.ndarray)) for s in sequences):
+        flat = torch.cat([torch.as_tensor(s) for s in sequences])
+    else:
+        flat = torch.tensor(list(itertools.chain.from_iterable(sequences)))
+    return flat, offsets
+
+
+def pack_bins(lengths, capacity):
+    """
+    Pack items of the given lengths into as few bins of a fixed capacity as
+    possible, using the Best-Fit Decreasing heuristic
+
+    Returns a list of bins, each a list of indices into `lengths`. Items longer
+    than the capacity are placed into a bin of their own. Lengths and capacity
+    must be integers
+
+    Open bins are grouped by their remaining capacity, and a Fenwick tree over
+    the number of bins with each remaining capacity finds the tightest one
+    that fits an item, so packing `n` items takes O(n log n + n log capacity)
+    time and O(n + capacity) memory
+    """
+
+    bins = []
+    # Heaps of the indices of open bins by remaining capacity, so that ties go
+    # to the earliest bin, and the Fenwick tree counting the open bins with
+    # each remaining capacity
+    open_bins = {}
+    tree = [0] * (capacity + 1)
+    num_open = 0
+    top_step = 1 << max(capacity.bit_length() - 1, 0)
+
+    for i in sort_unsort_pmts(lengths, descending=True)[0]:
+        length = lengths[i]
+
+        # Count the open bins with less remaining capacity than the item, then
+        # descend the tree to the smallest remaining capacity past that count
+        remaining = None
+        if length <= capacity:
+            target = 0
+            position = max(length, 1) - 1
+            while position > 0:
+                target += tree[position]
+                position &= position - 1
+            if target < num_open:
+                position = 0
+                step = top_step
+                while step:
+                    if position + step <= capacity and (
+                        tree[position + step] <= target
+                    ):
+                        position += step
+                        target -= tree[position]
+                    step >>= 1
+                remaining = position + 1
+
+        if remaining is not None:
+            bin_index = heapq.heappop(open_bins[remaining])
+            num_open -= 1
+            position = remaining
+            while position <= capacity:
+                tree[position] -= 1
+                position += position & -position
+            bins[bin_index].append(i)
+            remaining -= length
+        else:
+            bin_index = len(bins)
+            bins.append([i])
+            remaining = capacity - length
+        if remaining > 0:
+            heapq.heappush(open_bins.setdefault(remaining, []), bin_index)
+            num_open += 1
+            position = remaining
+            while position <= capacity:
+                tree[position] += 1
+                position += position & -position
+    return bins
 
 
 def partition(data, seq_len, batch_size):
@@ -66,7 +175,8 @@ def pad_and_batch(
     batch_size,
     padding_value,
     gradient_accumulation=1,
-    batch_shuffling="none"
+    batch_shuffling="none",
+    pack=False
 ):
     """
     Sort input sequences into batches based on sequence length, padding as
@@ -78,9 +188,18 @@ def pad_and_batch(
     compatibility, and batches can optionally be sorted. Final shape of the
     tensor will be (num_batches, max_seq_length, batch_size). Final shape of
     the lengths index will be (num_batches, batch_size)
+
+    If `pack` is `True`, the dataset additionally contains the unpadded
+    sequences as a nested tensor under `packed`, ordered the same as the
+    sequences in the (possibly shuffled) batched tensor, and the cumulative
+    sequence offsets under `cu_seqlens`. These can be consumed by
+    variable-length kernels (e.g. `flash_attn_varlen_func`) that avoid
+    computing over padding, like the flat batches of `VariableLengthDataset`
+    with `batch_by='packed'`. This is unrelated to RNN `PackedSequence`s (see
+    `return_packed_sequence` in `VariableLengthDataset`)
     """
 
-    lengths = [len(line) for line in data]
+    lengths = np.fromiter(map(len, data), dtype=np.int64, count=len(data))
     full_batch_size = batch_size * gradient_accumulation
     num_full_batches = math.floor(len(data) / full_batch_size)
     data = data[:num_full_batches * full_batch_size]
@@ -89,19 +208,32 @@ def pad_and_batch(
 
     sort_pmt, unsort_pmt = sort_unsort_pmts(lengths, descending=True)
     data = [data[i] for i in sort_pmt]
-    lengths = [lengths[i] for i in sort_pmt]
+    lengths = lengths[sort_pmt]
 
-    data = [torch.tensor(line) for line in data]
-    tensor = nn.utils.rnn.pad_sequence(data, padding_value=padding_value)
-    max_seq_len = tensor.size(0)
-    tensor = tensor.t().view(-1, batch_size, max_seq_len).transpose(1, 2)
-    lengths = list(np.array_split(np.array(lengths), num_batches))
+    flat, offsets = flatten_sequences(data)
+    offsets = offsets.tolist()
+    data = [flat[offsets[i]:offsets[i + 1]] for i in range(len(data))]
     if batch_shuffling != "none":
-        shuffle_pmt, unshuffle_pmt = shuffle_unshuffle_pmts(len(tensor))
-        tensor = tensor[shuffle_pmt, :, :]
-        lengths = [lengths[i] for i in shuffle_pmt]
+        shuffle_pmt, unshuffle_pmt = shuffle_unshuffle_pmts(num_batches)
+        batch_positions = unshuffle_pmt
+    else:
+        batch_positions = range(num_batches)
+
+    # Allocate the tensor directly in its final layout and copy each sorted
+    # sequence into the column of its (possibly shuffled) batch, rather than
+    # padding, transposing, and shuffling through intermediate copies
+    max_seq_len = int(lengths.max(initial=0))
+    tensor = torch.full(
+        (num_batches, max_seq_len, batch_size), padding_value, dtype=flat.dtype
+    )
+    for i, (line, length) in enumerate(zip(data, lengths.tolist())):
+        batch, column = divmod(i, batch_size)
+        tensor[batch_positions[batch], :length, column] = line
+    lengths = lengths.reshape(num_batches, batch_size)
+    if batch_shuffling != "none":
+        lengths = lengths[shuffle_pmt]
         data_set = {
-            'tensor': tensor.contiguous(),
+            'tensor': tensor,
             'lengths': lengths,
             'sort_pmt': sort_pmt,
             'unsort_pmt': unsort_pmt,
@@ -110,11 +242,24 @@ def pad_and_batch(
         }
     else:
         data_set = {
-            'tensor': tensor.contiguous(),
+            'tensor': tensor,
             'lengths': lengths,
             'sort_pmt': sort_pmt,
             'unsort_pmt': unsort_pmt
         }
+    if pack:
+        batch_order = data_set.get('batch_shuffle_pmt', range(num_batches))
+        packed_order = [
+            batch * batch_size + i for batch in batch_order
+            for i in range(batch_size)
+        ]
+        packed = [data[i] for i in packed_order]
+        packed_lengths = [len(line) for line in packed]
+        data_set['packed'] = torch.nested.nested_tensor(packed)
+        data_set['cu_seqlens'] = torch.tensor(
+            np.concatenate([[0], np.cumsum(packed_lengths)]),
+            dtype=torch.int32
+        )
     return data_set
 
 
@@ -123,7 +268,8 @@ def import_embeddings(
     vocab: Vocab,
     indices_path: str = None,
     init_range: float = 1.0,
-    logger: Logger = None
+    logger: Logger = None,
+    rng: np.random.Generator = None
 ):
     """
     Import pretrained NumPy embeddings for a given vocab, adding a randomized 
@@ -141,6 +287,9 @@ def import_embeddings(
         init_range: The positive end of the range around zero with which to
             initialize missing embeddings. Default: `1.0`
         logger: A logger through which to pipe informational messages
+        rng: The NumPy random Generator with which to initialize missing
+            embeddings. If `None`, the global NumPy random state is used.
+            Default: `None`
     Returns:
     """
     if logger:
@@ -154,18 +303,26 @@ def import_embeddings(
     with open(indices_path, "r") as f:
         embedding_tok_to_id = json.load(f)
     embedding_dim = embeddings.shape[1]
-    sorted_embeddings = []
-    randomized_embeddings = []
-    for idx in sorted(vocab.id_to_tok.keys()):
-        token = vocab.id_to_tok[idx]
-        if token in embedding_tok_to_id:
-            sorted_embeddings.append(embeddings[embedding_tok_to_id[token]])
-        else:
-            sorted_embeddings.append(
-                np.random.uniform(-init_range, init_range, (embedding_dim))
-            )
-            randomized_embeddings.append(token)
-    pretrained_embeddings = np.array(sorted_embeddings)
+    tokens = vocab.id_to_tok
+
+    # Find the pretrained row of each vocab item (-1 if it has none), then
+    # gather all found rows and randomly initialize all missing rows at once
+    source_rows = np.fromiter(
+        (embedding_tok_to_id.get(token, -1) for token in tokens),
+        dtype=np.int64,
+        count=len(tokens)
+    )
+    missing = (source_rows == -1)
+    pretrained_embeddings = np.empty(
+        (len(tokens), embedding_dim), dtype=embeddings.dtype
+    )
+    pretrained_embeddings[~missing] = embeddings[source_rows[~missing]]
+    if rng is None:
+        rng = np.random
+    pretrained_embeddings[missing] = rng.uniform(
+        -init_range, init_range, (np.count_nonzero(missing), embedding_dim)
+    )
+    randomized_embeddings = [tokens[i] for i in np.flatnonzero(missing)]
     assert pretrained_embeddings.shape[0] == len(vocab.id_to_tok)
     assert pretrained_embeddings.shape[1] == embedding_dim
     if logger:
@@ -204,7 +361,20 @@ def _lr_lambda(
     else:
         raise ValueError(f'Decay mode {decay} is not valid')
 
+    # Precompute the schedule for every training step using the same lambdas
+    # over a NumPy array of steps, so that each scheduler step is a single
+    # list lookup. Steps outside of the table fall back to the lambdas. The
+    # total may not be a whole number (e.g. when computed with `/`)
+    num_table_steps = math.ceil(total_num_steps)
+    steps = np.arange(num_table_steps)
+    is_warmup = steps < num_warmup_steps
+    schedule = np.empty(num_table_steps)
+    schedule[is_warmup] = warmup_lambda(steps[is_warmup])
+    schedule[~is_warmup] = decay_lambda(steps[~is_warmup])
+    schedule = schedule.tolist()
+
     lr_lambda = lambda step: (
+        schedule[step] if 0 <= step < num_table_steps else
         warmup_lambda(step) if step < num_warmup_steps else decay_lambda(step)
     )
     return lr_lambda
@@ -269,3 +439,66 @@ def get_lr_lambda_by_steps(
         gamma=gamma,
         gamma_steps=gamma_steps
     )
+
+
+def acyclic_viterbi_batched(
+    transitions: torch.Tensor, lengths=None, mode: str = 'max'
+):
+    """
+    Find the best path through each of a batch of acyclic transition matrices,
+    as in `chonker.compute.acyclic_viterbi`, running the recursion for the
+    whole batch at once on the device of `transitions` (e.g. the GPU)
+
+    Args:
+        transitions: A tensor of shape (batch_size, N, N), in which entry
+            `[b, i, j]` is the score of the transition from position `i` to
+            position `j + 1` in sequence `b`
+        lengths: A tensor or list of the length of each sequence. If `None`,
+            all sequences are of length `N`. Default: `None`
+        mode: Whether to find the path with the `max` or `min` total score.
+            Default: `max`
+    Returns:
+        The list of best paths, each a list of (previous, position) pairs, and
+        the tensor of their total scores
+    """
+    if mode != 'max' and mode != 'min':
+        raise ValueError(
+            f'Mode {mode} is not recognized. Valid modes are `max` and `min`'
+        )
+    batch_size, seq_length, _ = transitions.shape
+    if lengths is None:
+        lengths = [seq_length] * batch_size
+    lengths = torch.as_tensor(lengths, device=transitions.device)
+
+    # Transpose the transitions so that the scores into each position are a
+    # contiguous row, then take the best previous position for every sequence
+    # in the batch at each step
+    incoming = transitions.transpose(1, 2).contiguous()
+    scores = incoming.new_zeros((batch_size, seq_length + 1))
+    back = torch.full(
+        (batch_size, seq_length + 1),
+        -1,
+        dtype=torch.long,
+        device=transitions.device
+    )
+    for position in range(1, seq_length + 1):
+        candidates = incoming[:, position - 1, :position] + scores[:, :position]
+        if mode == 'max':
+            best_scores, best_previous = candidates.max(dim=-1)
+        else:
+            best_scores, best_previous = candidates.min(dim=-1)
+        scores[:, position] = best_scores
+        back[:, position] = best_previous
+
+    # Trace the back-pointers of each sequence on the CPU, collecting only the
+    # positions on the path and pairing up consecutive positions at the end
+    back = back.tolist()
+    best_paths = []
+    for pointers, length in zip(back, lengths.tolist()):
+        positions = [length, pointers[length]]
+        while positions[-1] > 0:
+            positions.append(pointers[positions[-1]])
+        positions.reverse()
+        best_paths.append(list(zip(positions, positions[1:])))
+    best_probs = scores[torch.arange(batch_size, device=scores.device), lengths]
+    return best_paths, best_probs
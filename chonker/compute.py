@@ -1,12 +1,98 @@
+import functools
+import warnings
 import numpy as np
-import sys
 
 
-def acyclic_viterbi(transitions: np.ndarray, mode='max', length=None):
+# Number of positions processed together as a block by the Viterbi recursion:
+# the block's running best scores and back-pointers (1KB) stay in L1 cache
+# while each earlier row of the transition matrix is swept once
+_VITERBI_BLOCK = 64
+
+
+def _viterbi_scan(transitions, scores, back, seq_length, sign):
+    """
+    Fill in the best path scores and back-pointers for `acyclic_viterbi` one
+    block of positions at a time
+
+    The transitions into a block from each earlier position are a contiguous
+    slice of that position's row, so they are read in order and compared
+    against the running bests of the whole block at once. Previous positions
+    are still visited in increasing order and only replace the best on a
+    strict improvement, so ties are broken in favor of the earliest position.
+    Scores are multiplied by `sign` (-1 when minimizing, of the same dtype as
+    `scores`) so the comparisons are the same in both modes
+    """
+    best = np.empty(_VITERBI_BLOCK, dtype=scores.dtype)
+    best_previous = np.empty(_VITERBI_BLOCK, dtype=np.int64)
+    scores[0] = 0.0
+    back[0] = -1
+    for block_start in range(1, seq_length + 1, _VITERBI_BLOCK):
+        block_end = min(block_start + _VITERBI_BLOCK, seq_length + 1)
+        width = block_end - block_start
+
+        # Transitions from the positions before the block
+        for k in range(width):
+            best[k] = sign * (transitions[0, block_start + k - 1] + scores[0])
+            best_previous[k] = 0
+        for previous in range(1, block_start):
+            previous_score = scores[previous]
+            row = transitions[previous, block_start - 1:block_end - 1]
+            for k in range(width):
+                score = sign * (row[k] + previous_score)
+                better = score > best[k]
+                best[k] = score if better else best[k]
+                best_previous[k] = previous if better else best_previous[k]
+
+        # Transitions from earlier positions within the block, in order
+        for k in range(width):
+            position = block_start + k
+            for previous in range(block_start, position):
+                score = sign * (
+                    transitions[previous, position - 1] + scores[previous]
+                )
+                if score > best[k]:
+                    best[k] = score
+                    best_previous[k] = previous
+            scores[position] = sign * best[k]
+            back[position] = best_previous[k]
+
+
+# The scalar scan is only worthwhile when it can be compiled, otherwise the
+# vectorized NumPy recursion in `acyclic_viterbi` is used. Numba is slow to
+# import, so it is only imported (and the scan compiled) on first use
+@functools.lru_cache(maxsize=None)
+def _compiled_viterbi_scan():
+    """Return `_viterbi_scan` compiled with Numba, or `None` without Numba"""
+    try:
+        import numba
+    except ImportError:
+        return None
+    return numba.njit(cache=True)(_viterbi_scan)
+
+
+def acyclic_viterbi(
+    transitions: np.ndarray, mode='max', length=None, dtype=None
+):
+    """
+    Find the best path from position 0 to the final position through an
+    acyclic transition matrix, maximizing or minimizing the summed scores
+
+    Scores are computed in `dtype`, by default float32 if the transitions are
+    float32 and float64 otherwise. Passing `np.float32` for large float64
+    matrices halves the memory read by the recursion, at the cost of
+    precision
+    """
     if mode != 'max' and mode != 'min':
-        sys.exit(
+        raise ValueError(
             f'Mode {mode} is not recognized. Valid modes are `max` and `min`'
         )
+    if dtype is None:
+        dtype = np.float32 if transitions.dtype == np.float32 else np.float64
+    elif np.dtype(dtype) != np.float32 and np.dtype(dtype) != np.float64:
+        raise ValueError(
+            f'Dtype {dtype} is not supported. Valid dtypes are `np.float32` '
+            'and `np.float64`'
+        )
 
     shape = transitions.shape
     assert len(shape) == 2
@@ -18,26 +104,72 @@ def acyclic_viterbi(transitions: np.ndarray, mode='max', length=None):
     else:
         seq_length = shape[0]
 
-    trellis = {}
-    trellis[0] = (0.0, -1)
-    for position in range(1, seq_length + 1):
-        trellis[position] = None
-        candidates = transitions[:, [position - 1]].T[0]
-        for previous in range(position):
-            candidates[previous] += trellis[previous][0]
-        if mode == 'max':
-            trellis[position] = (np.max(candidates), np.argmax(candidates))
-        else:
-            trellis[position] = (np.min(candidates), np.argmin(candidates))
-
-    position = seq_length
-    previous = trellis[position][1]
-    best_prob = trellis[position][0]
-    best_path = [(previous, position)]
-    while previous > 0:
-        position = previous
-        previous = trellis[position][1]
-        best_path.append((previous, position))
-
-    best_path.reverse()
+    # The best score of any path from position 0 to each position, and the
+    # previous position on that path
+    scores = np.empty(seq_length + 1, dtype=dtype)
+    back = np.empty(seq_length + 1, dtype=np.int64)
+
+    # Row `i` holds the transitions out of position `i`, so the transitions
+    # into a block of positions are contiguous within each row
+    original = transitions[:seq_length, :seq_length]
+    with np.errstate(over='ignore'):
+        transitions = np.ascontiguousarray(original, dtype=dtype)
+    if transitions.dtype.itemsize < original.dtype.itemsize and (
+        np.count_nonzero(np.isinf(transitions)) >
+        np.count_nonzero(np.isinf(original))
+    ):
+        warnings.warn(
+            f'Transitions overflowed when converted to {transitions.dtype}'
+        )
+    scan = _compiled_viterbi_scan()
+    if scan is not None:
+        scan(
+            transitions,
+            scores,
+            back,
+            seq_length,
+            scores.dtype.type(1 if mode == 'max' else -1)
+        )
+    else:
+        scores[0] = 0.0
+        back[0] = -1
+        select = np.argmax if mode == 'max' else np.argmin
+        better = np.greater if mode == 'max' else np.less
+        for block_start in range(1, seq_length + 1, _VITERBI_BLOCK):
+            block_end = min(block_start + _VITERBI_BLOCK, seq_length + 1)
+            block = slice(block_start, block_end)
+
+            # Transitions from the positions before the block, for the whole
+            # block at once
+            candidates = (
+                transitions[:block_start, block_start - 1:block_end - 1] +
+                scores[:block_start, None]
+            )
+            previous = select(candidates, axis=0)
+            scores[block] = np.take_along_axis(
+                candidates, previous[None, :], axis=0
+            )[0]
+            back[block] = previous
+
+            # Transitions from earlier positions within the block, in order
+            for position in range(block_start + 1, block_end):
+                candidates = (
+                    transitions[block_start:position, position - 1] +
+                    scores[block_start:position]
+                )
+                previous = select(candidates)
+                if better(candidates[previous], scores[position]):
+                    scores[position] = candidates[previous]
+                    back[position] = block_start + previous
+
+    # Follow the back-pointers as a plain list of ints, collecting only the
+    # positions on the path, and pair up consecutive positions at the end
+    pointers = back.tolist()
+    positions = [seq_length, pointers[seq_length]]
+    while positions[-1] > 0:
+        positions.append(pointers[positions[-1]])
+    positions.reverse()
+
+    best_path = list(zip(positions, positions[1:]))
+    best_prob = scores[seq_length]
     return best_path, best_prob
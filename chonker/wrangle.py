@@ -3,44 +3,186 @@ A module containing convenience classes and functions for the pre-processing
 of data being fed into statistical and machine learning models
 """
 
+import collections
 import copy
+import functools
 import itertools
+import json
+import os
 import re
+import sys
+import numpy as np
 import yaml
 
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# Use the libyaml bindings for saving and loading vocabularies when PyYAML was
+# built with them
+try:
+    from yaml import CSafeDumper as _YamlDumper, CSafeLoader as _YamlLoader
+except ImportError:
+    from yaml import SafeDumper as _YamlDumper, SafeLoader as _YamlLoader
+
+# Patterns used to tokenize <tags> away from adjacent tags, from preceding and
+# following non-whitespace characters, and from surrounding characters
+_TAG_RE_ADJ = re.compile(r"(<[A-Za-z0-9]*>)(?=<[A-Za-z0-9]*>)")
+_TAG_RE_SUFFIX = re.compile(r"(\S+)(<[A-Za-z0-9]*>)(\s+|$)")
+_TAG_RE_PREFIX = re.compile(r"(^|\s+)(<[A-Za-z0-9]*>)(\S+)")
+_TAG_RE_SURROUND = re.compile(r"(?=\S+)(<[A-Za-z0-9]*>)(?=\S+)")
+_WS_RE = re.compile(r'\s+')
+
+# A single-pass tokenizer equivalent to `tokenize_tags` followed by splitting
+# on whitespace: matches either a whole <tag>, or a run of non-whitespace
+# characters not containing a <tag>
+_TAG = r"<[A-Za-z0-9]*>"
+_TOKEN_RE = re.compile(rf"{_TAG}|(?:(?!{_TAG})\S)+")
+
+
+@functools.lru_cache(maxsize=32)
+def _compile_delimiter(delimiter):
+    """
+    Compile a delimiter pattern string, reusing the module-level whitespace
+    pattern, and cache the result across calls
+    """
+    if delimiter == _WS_RE.pattern:
+        return _WS_RE
+    return re.compile(delimiter)
+
+
+# Regex escapes for single characters, as allowed in a literal delimiter
+_CHAR_ESCAPES = {'t': '\t', 'n': '\n', 'r': '\r', 'f': '\f', 'v': '\v'}
+
+
+@functools.lru_cache(maxsize=32)
+def _literal_delimiter(delimiter):
+    """
+    Return the character repeated by a delimiter pattern of the form `c+`, if
+    `c` is a single literal or escaped character, otherwise `None`
+    """
+    if len(delimiter) < 2 or delimiter[-1] != '+':
+        return None
+    body = delimiter[:-1]
+    if len(body) == 1 and body not in '.^$*+?{}[]\\|()':
+        return body
+    if len(body) == 2 and body[0] == '\\':
+        if body[1] in _CHAR_ESCAPES:
+            return _CHAR_ESCAPES[body[1]]
+        if not body[1].isalnum():
+            return body[1]
+    return None
+
+
+def _split_literal(line, char):
+    """
+    Split a string on runs of a single character with `str.split`, giving the
+    same result as a regex split on `char+`
+    """
+    parts = line.split(char)
+    if len(parts) <= 2:
+        return parts
+    # Consecutive delimiters leave empty strings between them, which a regex
+    # split on runs would not give. Those at the edges are kept
+    return [parts[0]] + [part for part in parts[1:-1] if part] + [parts[-1]]
+
 
 def get_lines(file):
     """
     Return all lines from a file stripping newline characters and ignoring
     empty lines
     """
-    all_lines = [line.strip('\n') for line in open(file, 'r')]
-    return [line for line in all_lines if line != '']
+    with open(file, 'r') as f:
+        return [line for line in f.read().split('\n') if line != '']
+
+
+def iter_lines(file):
+    """
+    Yield the lines from a file one at a time, stripping newline characters and
+    ignoring empty lines, without reading the whole file into memory
+    """
+    with open(file, 'r') as f:
+        for line in f:
+            line = line.rstrip('\n')
+            if line != '':
+                yield line
 
 
 def tokenize_tags(string):
     """Tokenize <tags> away from surrounding non-whitespace characters"""
-    string = re.sub(r"(<[A-Za-z0-9]*>)(?=<[A-Za-z0-9]*>)", r"\1 ", string)
-    string = re.sub(r"(\S+)(<[A-Za-z0-9]*>)(\s+|$)", r"\1 \2\3", string)
-    string = re.sub(r"(^|\s+)(<[A-Za-z0-9]*>)(\S+)", r"\1\2 \3", string)
-    return re.sub(r"(?=\S+)(<[A-Za-z0-9]*>)(?=\S+)", r" \1 ", string)
+    string = _TAG_RE_ADJ.sub(r"\1 ", string)
+    string = _TAG_RE_SUFFIX.sub(r"\1 \2\3", string)
+    string = _TAG_RE_PREFIX.sub(r"\1\2 \3", string)
+    return _TAG_RE_SURROUND.sub(r" \1 ", string)
+
+
+def tokenize_and_split(line):
+    """
+    Split a string on whitespace, with <tags> tokenized away from surrounding
+    non-whitespace characters, in a single pass
+
+    Gives the same result as splitting the output of `tokenize_tags` on
+    whitespace, including the empty strings produced by leading or trailing
+    whitespace
+    """
+    return _add_edge_tokens(line, _TOKEN_RE.findall(line))
+
+
+def _split_whitespace(line):
+    """
+    Split a string on runs of whitespace with `str.split`, which gives the same
+    result as `_WS_RE.split` but without going through the regex engine
+    """
+    return _add_edge_tokens(line, line.split())
 
 
-def split_lines(lines, delimiter=r'\s+', split_tags=False):
-    """Split a list of strings based on a regex delimiter"""
+def _add_edge_tokens(line, tokens):
+    """
+    Add the empty strings that a regex split on whitespace gives for leading
+    or trailing whitespace to the tokens of a line
+    """
+    if not line or line[0].isspace():
+        tokens.insert(0, '')
+    if line and line[-1].isspace():
+        tokens.append('')
+    return tokens
+
+
+def split_lines(lines, delimiter=_WS_RE, split_tags=False):
+    """
+    Split a list of strings based on a regex delimiter, given either as a
+    pattern string or a compiled pattern
+    """
+    if isinstance(delimiter, str):
+        char = _literal_delimiter(delimiter)
+        if char is not None:
+            if split_tags:
+                lines = [tokenize_tags(line) for line in lines]
+            return [_split_literal(line, char) for line in lines]
+        delimiter = _compile_delimiter(delimiter)
+    if delimiter is _WS_RE:
+        if split_tags:
+            return [tokenize_and_split(line) for line in lines]
+        return [_split_whitespace(line) for line in lines]
     if split_tags:
         lines = [tokenize_tags(line) for line in lines]
-    return [re.split(delimiter, line) for line in lines]
+    return [delimiter.split(line) for line in lines]
 
 
 def flatten(multi_list):
-    """Flatten a list of lists into a single list"""
+    """
+    Flatten a list of lists into a single list
+
+    Callers that only iterate over the result once should consume
+    `itertools.chain.from_iterable` directly rather than building the list
+    """
     return list(itertools.chain.from_iterable(multi_list))
 
 
 def is_tag(word):
     """Define a word as a tag if it starts and ends with angle brackets"""
-    return word.startswith('<') and word.endswith('>')
+    return word[:1] == '<' and word[-1:] == '>'
 
 
 def case(string, preserve=False):
@@ -54,30 +196,105 @@ def chars_from_words(sequence):
     """
     From a list of tokenized words, return the same list with the words
     sub-tokenized into characters, unless the word is a tag
+
+    Sequences without any tags are split with a single `map`
     """
+    sequence = list(sequence)
+    if '<' not in ''.join(sequence):
+        return list(map(list, sequence))
     return [
-        [char for char in word] if not is_tag(word) else [word]
+        [word] if word[:1] == '<' and word[-1:] == '>' else list(word)
         for word in sequence
     ]
 
 
+def _file_key(file):
+    """
+    Identify the current contents of a file by its resolved path, inode, size
+    and modification time, for caching results computed from it
+    """
+    stat = os.stat(file)
+    return (os.path.realpath(file), stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+
+def _edged(text, edge_tokens):
+    """
+    Return a cached tokenized text as a new list of lists, adding <bos> and
+    <eos> tokens to each line if `edge_tokens`
+    """
+    if edge_tokens:
+        return [['<bos>', *line, '<eos>'] for line in text]
+    return [list(line) for line in text]
+
+
+def _split_file(file, preserve_case, split_tags):
+    """
+    Whitespace split the lines of a file, lowercasing them unless
+    `preserve_case`
+
+    Lines are lowercased in one call before they are split rather than word by
+    word, which gives the same result since lowercasing never adds or removes
+    whitespace. When splitting <tags>, this is only done for ASCII lines: some
+    non-ASCII characters lowercase to ASCII letters (e.g. the Kelvin sign to
+    `k`), which could then form a tag that the original line did not contain,
+    so other lines are lowercased word by word after splitting
+    """
+    lines = get_lines(file)
+    if preserve_case:
+        return split_lines(lines, split_tags=split_tags)
+    if not split_tags:
+        return split_lines([line.lower() for line in lines])
+
+    is_ascii = [line.isascii() for line in lines]
+    lines = [
+        line.lower() if ascii_line else line
+        for line, ascii_line in zip(lines, is_ascii)
+    ]
+    return [
+        words if ascii_line else [word.lower() for word in words]
+        for words, ascii_line in
+        zip(split_lines(lines, split_tags=True), is_ascii)
+    ]
+
+
+# Tokenized texts are only cached when a caller asks for it, as tuples keyed by
+# `_file_key`, so that repeatedly tokenizing an unchanged file is only a copy.
+# Each entry holds a whole corpus, so only a few are kept
+@functools.lru_cache(maxsize=4)
+def _cached_basic_tokenize(file_key, preserve_case, split_tags):
+    text = _split_file(file_key[0], preserve_case, split_tags)
+    return tuple(tuple(line) for line in text)
+
+
 def basic_tokenize(
     in_file,
     preserve_case=False,
     split_tags=False,
     edge_tokens=False,
-    out_file=None
+    out_file=None,
+    cache=False
 ):
     """
     Whitespace tokenize the input file, convert to lowercase and return the 
     tokenized text
 
     If an `out_file` is given, print the tokenized text to this file
+
+    If `cache` is `True`, the tokenized text is kept in memory until the input
+    file changes, so that tokenizing it again skips reading and splitting the
+    file (the result is still a new copy). Up to four texts are kept; call
+    `clear_cache` to release them. Texts printed to an `out_file` are never
+    cached
     """
-    text = split_lines(get_lines(in_file), split_tags=split_tags)
-    text = [[case(word, preserve_case) for word in line] for line in text]
+    if cache and not out_file:
+        text = _cached_basic_tokenize(
+            _file_key(in_file), preserve_case, split_tags
+        )
+        return _edged(text, edge_tokens)
+
+    text = _split_file(in_file, preserve_case, split_tags)
     if edge_tokens:
-        text = [['<bos>'] + line + ['<eos>'] for line in text]
+        text = [['<bos>', *line, '<eos>'] for line in text]
     if out_file:
         with open(out_file, 'w') as f:
             for line in text:
@@ -86,31 +303,61 @@ def basic_tokenize(
         return text
 
 
+def _characters(words, preserve_tags):
+    """
+    Split a list of words into a single list of characters, keeping <tags>
+    whole if `preserve_tags`
+
+    Lines without any tags are split in one call on the joined line
+    """
+    line = ''.join(words)
+    if preserve_tags and '<' in line:
+        return list(
+            itertools.chain.from_iterable(
+                [word] if word[:1] == '<' and word[-1:] == '>' else word
+                for word in words
+            )
+        )
+    return list(line)
+
+
+@functools.lru_cache(maxsize=4)
+def _cached_character_tokenize(
+    file_key, preserve_case, split_tags, preserve_tags
+):
+    text = _split_file(file_key[0], preserve_case, split_tags)
+    return tuple(tuple(_characters(line, preserve_tags)) for line in text)
+
+
 def character_tokenize(
     in_file,
     preserve_case=False,
     split_tags=True,
     preserve_tags=True,
     edge_tokens=False,
-    out_file=None
+    out_file=None,
+    cache=False
 ):
     """
     Character tokenize the input file, lowercasing and exlcuding whitespace
     
     If an `out_file` is given print the tokenized text to this file
+
+    If `cache` is `True`, the tokenized text is kept in memory until the input
+    file changes, as in `basic_tokenize`. Call `clear_cache` to release it
     """
-    text = split_lines(get_lines(in_file), split_tags=split_tags)
+    if cache and not out_file:
+        text = _cached_character_tokenize(
+            _file_key(in_file), preserve_case, split_tags, preserve_tags
+        )
+        return _edged(text, edge_tokens)
+
     text = [
-        flatten(
-            [
-                [case(word, preserve_case)] if (is_tag(word) and preserve_tags)
-                else [char for char in case(word, preserve_case)]
-                for word in line
-            ]
-        ) for line in text
+        _characters(line, preserve_tags)
+        for line in _split_file(in_file, preserve_case, split_tags)
     ]
     if edge_tokens:
-        text = [['<bos>'] + line + ['<eos>'] for line in text]
+        text = [['<bos>', *line, '<eos>'] for line in text]
     if out_file:
         with open(out_file, 'w') as f:
             for line in text:
@@ -119,42 +366,111 @@ def character_tokenize(
         return text
 
 
-def get_ngrams(corpus, max_length, min_length=1, min_count=1):
+def clear_cache():
+    """
+    Release the tokenized texts cached by `basic_tokenize` and
+    `character_tokenize` when called with `cache=True`
+    """
+    _cached_basic_tokenize.cache_clear()
+    _cached_character_tokenize.cache_clear()
+
+
+def _id_ngram_counts(ids, lengths, n, vocab_size):
+    """
+    Count the `n`-grams of token IDs within each sentence of a flat ID array,
+    in order of first occurrence
+    """
+    num_windows = len(ids) + 1 - n
+    if num_windows <= 0:
+        return {}
+
+    # Keep only the windows that start far enough from the end of their
+    # sentence not to cross into the next one
+    starts = np.repeat(np.cumsum(lengths) - lengths, lengths)
+    positions = np.arange(len(ids)) - starts
+    valid = positions <= np.repeat(lengths, lengths) - n
+    windows = np.lib.stride_tricks.sliding_window_view(ids, n)
+    windows = windows[valid[:num_windows]]
+
+    if vocab_size**n <= np.iinfo(np.int64).max:
+        # Pack each ngram into a single integer key in base `vocab_size`
+        place_values = vocab_size**np.arange(n - 1, -1, -1, dtype=np.int64)
+        _, first, counts = np.unique(
+            windows @ place_values, return_index=True, return_counts=True
+        )
+    else:
+        _, first, counts = np.unique(
+            windows, axis=0, return_index=True, return_counts=True
+        )
+
+    order = np.argsort(first)
+    return {
+        tuple(windows[index].tolist()): count
+        for index, count in zip(first[order].tolist(), counts[order].tolist())
+    }
+
+
+def get_ngrams(corpus, max_length, min_length=1, min_count=1, vocab=None):
     """
     Get 1-to-n-grams over a corpus of input sentences, discarding entries if
     they occur less than `min_count` times, as well as bidrectional dictionary
     of ngrams and indices
+
+    If a `Vocab` is given, the ngrams are tuples of the token IDs from the
+    vocabulary rather than tuples of the tokens, and are counted as arrays.
+    `min_length` must be at least 1
     """
-    counts = {}
+    if min_length < 1:
+        raise ValueError(f'Minimum ngram length {min_length} is less than 1')
+    if vocab is not None:
+        ids = vocab.to_ids(itertools.chain.from_iterable(corpus))
+        ids = np.asarray(ids, dtype=np.int64)
+        lengths = np.array([len(sentence) for sentence in corpus])
+        counts = {}
+        for n in range(min_length, max_length + 1):
+            counts.update(_id_ngram_counts(ids, lengths, n, vocab.size()))
+    else:
+        counts = collections.Counter()
+        for n in range(min_length, max_length + 1):
+            for sentence in corpus:
+                # Zipping the sentence with its shifted copies builds each
+                # ngram tuple in C
+                counts.update(zip(*(sentence[i:] for i in range(n))))
 
-    for n in range(min_length, max_length + 1):
-        for sentence in corpus:
-            sentence_length = len(sentence)
-            num_ngrams = sentence_length + 1 - n
-            for i in range(num_ngrams):
-                ngram = tuple(sentence[i:i + n])
-                if ngram not in counts:
-                    counts[ngram] = 1
-                else:
-                    counts[ngram] += 1
-
-    to_delete = []
-    for ngram in counts.keys():
-        if counts[ngram] < min_count:
-            to_delete.append(ngram)
-    for ngram in to_delete:
-        del counts[ngram]
-
-    ngram_to_id = {}
-    id_to_ngram = {}
-    for ngram in counts.keys():
-        index = len(ngram_to_id)
-        ngram_to_id[ngram] = index
-        id_to_ngram[index] = ngram
+    counts = {
+        ngram: count
+        for ngram, count in counts.items() if count >= min_count
+    }
+
+    ngram_to_id = dict(zip(counts, itertools.count()))
+    id_to_ngram = dict(enumerate(counts))
 
     return (counts, (ngram_to_id, id_to_ngram))
 
 
+def _intern(token):
+    """Intern a string token, leaving tokens of other types unchanged"""
+    return sys.intern(token) if type(token) == str else token
+
+
+def _vocab_format(file):
+    """
+    Choose the format of a saved `Vocab` from the file extension: MessagePack
+    for `.msgpack`, yaml for `.yaml` or `.yml`, and json otherwise
+    """
+    extension = os.path.splitext(file)[1].lower()
+    if extension == '.msgpack':
+        if msgpack is None:
+            raise ImportError(
+                'The msgpack package is required to save or load `.msgpack` '
+                'vocabulary files'
+            )
+        return 'msgpack'
+    if extension in ('.yaml', '.yml'):
+        return 'yaml'
+    return 'json'
+
+
 class Vocab():
     """
     A bi-directional mapping between the string tokens and integer IDs, 
@@ -165,38 +481,61 @@ class Vocab():
 
         self.unk_token = unk_token
 
+        if isinstance(other_tokens, str):
+            other_tokens = (other_tokens, )
+
+        # Add the special tokens followed by the source in a single pass
         self.tok_to_id = {}
-        self.id_to_tok = {}
-        self.add_vocab([self.unk_token])
-        if other_tokens:
-            self.add_vocab(other_tokens)
+        self.id_to_tok = []
+        self._add_unique(
+            dict.fromkeys(
+                itertools.chain(
+                    (self.unk_token, ),
+                    other_tokens or (),
+                    itertools.chain.from_iterable(source or ())
+                )
+            )
+        )
         self.unk_id = self.tok_to_id[self.unk_token]
 
-        if source:
-            self.add_source(source)
-
         self._check_invariant()
 
     def _check_invariant(self):
+        """
+        Check that both mappings are the same size and that each token's ID is
+        its index in `id_to_tok`
+
+        New items are always given the next ID, so this holds inductively and is
+        only checked when a `Vocab` is created, saved or loaded
+        """
         size_1 = len(self.tok_to_id)
         size_2 = len(self.id_to_tok)
         same_size = (size_1 == size_2)
         assert same_size
-        id_range = sorted(self.id_to_tok.keys())
+        id_range = [self.tok_to_id[token] for token in self.id_to_tok]
         gold_range = list(range(len(self.id_to_tok)))
-        contiguous = (id_range == gold_range)
-        assert contiguous
+        consistent = (id_range == gold_range)
+        assert consistent
 
     def add_vocab(self, tokens):
         """Add vocabulary items directly as a string or iterable of strings"""
-        if type(tokens) == str:
-            tokens = [tokens]
-        for token in tokens:
-            if token not in self.tok_to_id:
-                index = len(self.tok_to_id)
-                self.tok_to_id[token] = index
-                self.id_to_tok[index] = token
-        self._check_invariant()
+        if isinstance(tokens, str):
+            tokens = (tokens, )
+        self._add_unique(dict.fromkeys(tokens))
+
+    def _add_unique(self, tokens):
+        """
+        Add an iterable of distinct tokens in one bulk update of both mappings,
+        skipping those already present
+        """
+        # Intern new tokens so that every copy of a token read from a source
+        # shares one string object with a cached hash
+        new_tokens = [
+            _intern(token) for token in tokens if token not in self.tok_to_id
+        ]
+        start = len(self.tok_to_id)
+        self.tok_to_id.update(zip(new_tokens, itertools.count(start)))
+        self.id_to_tok.extend(new_tokens)
 
     def add_source(self, source):
         """
@@ -204,20 +543,48 @@ class Vocab():
         present
         """
         # Hack, this has the effect of creating a set while preserving the order
-        # of the elements
-        tokens = list(dict.fromkeys(flatten(source)))
-        self.add_vocab(tokens)
+        # of the elements. The chained source is consumed lazily, without first
+        # building a flat list of every token
+        self._add_unique(dict.fromkeys(itertools.chain.from_iterable(source)))
+
+    def clone(self):
+        """
+        Return an independent copy of the `Vocab` object
+
+        The mappings only hold strings and integers, so copying the mappings
+        themselves is equivalent to a deep copy
+        """
+        new_vocab = self.__class__.__new__(self.__class__)
+        new_vocab.__dict__.update(self.__dict__)
+        new_vocab.tok_to_id = self.tok_to_id.copy()
+        new_vocab.id_to_tok = self.id_to_tok.copy()
+        return new_vocab
+
+    def __deepcopy__(self, memo):
+        """
+        Deep copy the `Vocab` object, copying the mappings as in `clone`
+        rather than copying every token, and deep copying any other attributes
+        """
+        new_vocab = self.__class__.__new__(self.__class__)
+        memo[id(self)] = new_vocab
+        for name, value in self.__dict__.items():
+            if name == 'tok_to_id' or name == 'id_to_tok':
+                value = value.copy()
+            else:
+                value = copy.deepcopy(value, memo)
+            setattr(new_vocab, name, value)
+        return new_vocab
 
     def source_added(self, source):
         """Return new copy of `Vocab` object with new source text added"""
-        new_vocab = copy.deepcopy(self)
+        new_vocab = self.clone()
         new_vocab.add_source(source)
         return new_vocab
 
     def reset(self):
         """Completely empty all vocabulary items"""
         self.tok_to_id = {}
-        self.id_to_tok = {}
+        self.id_to_tok = []
 
     def size(self):
         """Return the size of the vocabulary (number of unique IDs)"""
@@ -231,41 +598,95 @@ class Vocab():
         Take in a string or list of string tokens and return the list of their 
         corresponding integer IDs
         """
-        if type(tokens) == str:
-            tokens = [tokens]
-        output = [
-            self.tok_to_id[token] if token in self.tok_to_id else self.unk_id
-            for token in tokens
-        ]
-        return output
+        if isinstance(tokens, str):
+            return [self.tok_to_id.get(tokens, self.unk_id)]
+        get_id = self.tok_to_id.get
+        unk_id = self.unk_id
+        return [get_id(token, unk_id) for token in tokens]
+
+    def to_ids_array(self, tokens):
+        """
+        Take in a string or list of string tokens and return a NumPy array of
+        their corresponding integer IDs, without building an intermediate list
+        """
+        if isinstance(tokens, str):
+            tokens = (tokens, )
+        get_id = self.tok_to_id.get
+        unk_id = self.unk_id
+        return np.fromiter(
+            (get_id(token, unk_id) for token in tokens),
+            dtype=np.int32,
+            count=len(tokens)
+        )
+
+    def to_ids_batch(self, sequences):
+        """
+        Take in a list of lists of string tokens and return a list of NumPy
+        arrays of their corresponding integer IDs
+
+        All of the tokens are converted in one pass over the flattened
+        sequences, and the result is split back into one view per sequence
+        """
+        if len(sequences) == 0:
+            return []
+        lengths = np.fromiter(
+            map(len, sequences), dtype=np.int64, count=len(sequences)
+        )
+        get_id = self.tok_to_id.get
+        unk_id = self.unk_id
+        ids = np.fromiter(
+            (
+                get_id(token, unk_id)
+                for token in itertools.chain.from_iterable(sequences)
+            ),
+            dtype=np.int32,
+            count=int(lengths.sum())
+        )
+        return np.split(ids, np.cumsum(lengths)[:-1])
 
     def to_tokens(self, ids):
         """
         Take in an integer ID or list of IDs and return the list of their 
         corresponding string tokens
         """
-        if type(ids) == int:
-            ids = [ids]
-        output = [
-            self.id_to_tok[item] if item in self.id_to_tok else self.unk_token
-            for item in ids
+        if isinstance(ids, (int, np.integer)):
+            if 0 <= ids < len(self.id_to_tok):
+                return [self.id_to_tok[ids]]
+            return [self.unk_token]
+        id_to_tok = self.id_to_tok
+        size = len(id_to_tok)
+        unk_token = self.unk_token
+        return [
+            id_to_tok[item] if 0 <= item < size else unk_token for item in ids
         ]
-        return output
 
     def save(self, out_file):
         """
-        Save the `Vocab` mapping to a yaml file
+        Save the `Vocab` mapping to a json, yaml or MessagePack file, depending
+        on the file extension (json unless it is `.yaml`, `.yml` or `.msgpack`)
 
-        By default, the yaml object will be sorted by key (the token id)
+        A yaml object will be sorted by key (the token id)
         """
-        save_dict = self.id_to_tok.copy()
+        self._check_invariant()
+        save_dict = dict(enumerate(self.id_to_tok))
         save_dict.update({'unknown': self.unk_token})
-        with open(out_file, 'w') as f:
-            yaml.dump(save_dict, f)
+        vocab_format = _vocab_format(out_file)
+        if vocab_format == 'msgpack':
+            with open(out_file, 'wb') as f:
+                msgpack.pack(save_dict, f)
+        else:
+            with open(out_file, 'w') as f:
+                if vocab_format == 'yaml':
+                    yaml.dump(save_dict, f, Dumper=_YamlDumper)
+                else:
+                    json.dump(save_dict, f)
 
     def load(self, in_file):
         """
-        Load the `Vocab` mapping from a saved yaml file
+        Load the `Vocab` mapping from a saved json, yaml or MessagePack file
+
+        Files without a `.yaml`, `.yml` or `.msgpack` extension that are not
+        valid json are read as yaml, as saved by earlier versions
 
         NOTE: loading a saved Vocab will reset the current object, including any
         special tokens
@@ -273,13 +694,78 @@ class Vocab():
         self.unk_id = None
         self.unk_token = None
         self.tok_to_id = {}
-        with open(in_file, 'r') as f:
-            self.id_to_tok = yaml.load(f, Loader=yaml.SafeLoader)
-        self.unk_token = self.id_to_tok['unknown']
-        del self.id_to_tok['unknown']
-        for id in self.id_to_tok:
-            self.tok_to_id[self.id_to_tok[id]] = id
+        vocab_format = _vocab_format(in_file)
+        if vocab_format == 'msgpack':
+            with open(in_file, 'rb') as f:
+                loaded = msgpack.unpack(f, strict_map_key=False)
+        else:
+            with open(in_file, 'r') as f:
+                if vocab_format == 'json':
+                    try:
+                        loaded = json.load(f)
+                    except json.JSONDecodeError:
+                        f.seek(0)
+                        vocab_format = 'yaml'
+                if vocab_format == 'yaml':
+                    loaded = yaml.load(f, Loader=_YamlLoader)
+        self.unk_token = loaded.pop('unknown')
+        # json object keys are always strings
+        loaded = {int(id): token for id, token in loaded.items()}
+        self.id_to_tok = [_intern(loaded[id]) for id in range(len(loaded))]
+        self.tok_to_id = {token: id for id, token in enumerate(self.id_to_tok)}
         self.unk_id = self.tok_to_id[self.unk_token]
+        self._check_invariant()
+
+    def save_txt(self, out_file):
+        """
+        Save the `Vocab` tokens to a plain text file, one token per line in
+        order of ID
+
+        This is the fastest format to save and load large vocabularies. The
+        unknown token must have ID 0, and no token may contain a newline
+        """
+        self._check_invariant()
+        if not self.id_to_tok:
+            raise ValueError('Empty vocabularies cannot be saved as text')
+        if self.unk_id != 0:
+            raise ValueError(
+                'Only vocabularies with the unknown token at ID 0 can be saved'
+                ' as text'
+            )
+        if any('\n' in token for token in self.id_to_tok):
+            raise ValueError(
+                'Vocabularies with tokens containing newlines cannot be saved'
+                ' as text'
+            )
+        with open(out_file, 'w', encoding='utf-8', newline='') as f:
+            f.writelines(token + '\n' for token in self.id_to_tok)
+
+    def load_txt(self, in_file):
+        """
+        Load the `Vocab` tokens from a plain text file saved by `save_txt`,
+        taking the first token as the unknown token
+
+        Tokens are separated by '\n' only, with an optional final newline.
+        Carriage returns are kept as part of the tokens, since `save_txt` allows
+        them, so files with '\r\n' line endings should be converted first
+
+        NOTE: loading a saved Vocab will reset the current object, including any
+        special tokens
+        """
+        with open(in_file, 'r', encoding='utf-8', newline='') as f:
+            text = f.read()
+        if not text:
+            raise ValueError(f'Vocabulary file {in_file} is empty')
+        # Split only on the newlines written by `save_txt`, so that empty
+        # tokens and other line-breaking characters are kept. The final newline
+        # may be missing from files written by hand
+        if text.endswith('\n'):
+            text = text[:-1]
+        self.id_to_tok = [_intern(token) for token in text.split('\n')]
+        self.tok_to_id = {token: id for id, token in enumerate(self.id_to_tok)}
+        self.unk_id = 0
+        self.unk_token = self.id_to_tok[0]
+        self._check_invariant()
 
     @classmethod
     def from_saved(cls, in_file):
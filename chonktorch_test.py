@@ -0,0 +1,375 @@
+import itertools
+import json
+import random
+import pytest
+import numpy as np
+import torch
+from chonker import compute as cp
+from chonker import wrangle as wr
+from chonker.chonktorch import data as ctd
+from chonker.chonktorch import functions as ctf
+
+
+def test_dataset_feature_dimension():
+    sequences = [torch.randn(3, 4), torch.randn(2, 4)]
+    dataset = ctd.VariableLengthDataset(sequences, 2, 0)
+    tensor, lengths = dataset[0]
+    assert tensor.shape == (3, 2, 4)
+    assert lengths == [3, 2]
+    assert torch.equal(tensor[:, 0], sequences[0])
+    assert torch.equal(tensor[:2, 1], sequences[1])
+    assert torch.equal(tensor[2, 1], torch.zeros(4))
+
+    arrays = [sequence.numpy() for sequence in sequences]
+    array_tensor, _ = ctd.VariableLengthDataset(arrays, 2, 0)[0]
+    assert torch.equal(array_tensor, tensor)
+
+
+def test_sort_unsort_pmts():
+    # Ties keep their original order in both directions
+    sort_pmt, unsort_pmt = ctf.sort_unsort_pmts([3, 1, 3, 2], descending=True)
+    assert sort_pmt == [0, 2, 3, 1]
+    assert unsort_pmt == [0, 3, 1, 2]
+    assert ctf.sort_unsort_pmts([3, 1, 3, 2])[0] == [1, 3, 0, 2]
+    unsigned = np.array([0, 3, 1], dtype=np.uint8)
+    assert ctf.sort_unsort_pmts(unsigned, descending=True)[0] == [1, 2, 0]
+    assert ctf.sort_unsort_pmts(['b', 'c', 'a'], descending=True)[0] == [
+        1, 0, 2
+    ]
+    assert ctf.sort_unsort_pmts([(1, 2), (0, 5), (1, 2)], True)[0] == [0, 2, 1]
+    assert ctf.sort_unsort_pmts([]) == ([], [])
+
+
+def test_lr_lambda_fractional_steps():
+    lr_lambda = ctf.get_lr_lambda_by_steps(100.0, 10)
+    assert lr_lambda(5) == pytest.approx(0.6)
+    assert lr_lambda(50) == pytest.approx(49 / 90)
+    by_epoch = ctf.get_lr_lambda_by_epoch(2, 12.5, num_warmup_epochs=1)
+    assert by_epoch(12) == pytest.approx(13 / 12.5)
+    assert by_epoch(20) == pytest.approx(4 / 12.5)
+
+
+@pytest.mark.parametrize('mode', ['max', 'min'])
+def test_acyclic_viterbi_batched(mode):
+    rng = np.random.default_rng(0)
+    seq_length = 70
+    lengths = [70, 1, 64, 65, 33]
+    transitions = rng.normal(size=(len(lengths), seq_length, seq_length))
+    excluded = -np.inf if mode == 'max' else np.inf
+    transitions[:, np.tri(seq_length, k=-1, dtype=bool)] = excluded
+    paths, scores = ctf.acyclic_viterbi_batched(
+        torch.from_numpy(transitions), lengths=lengths, mode=mode
+    )
+    for b, length in enumerate(lengths):
+        path, score = cp.acyclic_viterbi(
+            transitions[b], mode=mode, length=length
+        )
+        assert paths[b] == path
+        assert scores[b].item() == pytest.approx(score)
+
+    paths, _ = ctf.acyclic_viterbi_batched(
+        torch.from_numpy(transitions), mode=mode
+    )
+    assert paths[0] == cp.acyclic_viterbi(transitions[0], mode=mode)[0]
+
+
+def test_pack_bins():
+    lengths = [5, 3, 8, 2, 12, 1, 4, 7]
+    capacity = 10
+    bins = ctf.pack_bins(lengths, capacity)
+    assert sorted(itertools.chain.from_iterable(bins)) == list(range(8))
+    for indices in bins:
+        total = sum(lengths[i] for i in indices)
+        assert total <= capacity or len(indices) == 1
+    # The oversize item gets a bin of its own, and the rest fill three bins
+    assert [4] in bins
+    assert len(bins) == 4
+    assert ctf.pack_bins([], capacity) == []
+
+
+def reference_best_fit(lengths, capacity):
+    """Best-Fit Decreasing by scanning every bin for the tightest fit"""
+    bins = []
+    totals = []
+    order = sorted(range(len(lengths)), key=lambda i: -lengths[i])
+    for i in order:
+        fits = [
+            (capacity - total, b) for b, total in enumerate(totals)
+            if 0 < capacity - total and lengths[i] <= capacity - total
+        ]
+        if fits:
+            _, b = min(fits)
+            bins[b].append(i)
+            totals[b] += lengths[i]
+        else:
+            bins.append([i])
+            totals.append(lengths[i])
+    return bins
+
+
+def test_pack_bins_best_fit():
+    rng = np.random.default_rng(0)
+    for capacity in [1, 2, 7, 16, 33]:
+        for _ in range(20):
+            lengths = rng.integers(0, capacity + 3, rng.integers(0, 40))
+            lengths = lengths.tolist()
+            assert ctf.pack_bins(lengths, capacity) == reference_best_fit(
+                lengths, capacity
+            )
+
+
+def all_batches(dataset):
+    return [dataset[i] for i in range(len(dataset))]
+
+
+def assert_same_batches(batches_1, batches_2):
+    assert len(batches_1) == len(batches_2)
+    for batch_1, batch_2 in zip(batches_1, batches_2):
+        assert torch.equal(batch_1[0], batch_2[0])
+        assert list(batch_1[1]) == list(batch_2[1])
+        for extra_1, extra_2 in zip(batch_1[2:], batch_2[2:]):
+            assert torch.equal(extra_1, extra_2)
+
+
+@pytest.fixture(scope='module')
+def sequences():
+    rng = np.random.default_rng(0)
+    return [
+        rng.integers(1, 100, rng.integers(1, 20)).tolist() for _ in range(50)
+    ]
+
+
+@pytest.mark.parametrize('batch_by', ['sequences', 'tokens', 'packed'])
+def test_dataset_from_flat_and_saved(sequences, batch_by, tmp_path):
+    batch_size = 4 if batch_by == 'sequences' else 40
+    kwargs = dict(batch_by=batch_by, drop_final=True, max_padding=10)
+    dataset = ctd.VariableLengthDataset(sequences, batch_size, 0, **kwargs)
+    batches = all_batches(dataset)
+    assert len(batches) > 1
+
+    flat = np.concatenate(sequences)
+    offsets = np.concatenate([[0], np.cumsum([len(s) for s in sequences])])
+    flat_dataset = ctd.VariableLengthDataset.from_flat(
+        flat, offsets, batch_size, 0, **kwargs
+    )
+    assert_same_batches(all_batches(flat_dataset), batches)
+
+    dataset.save(str(tmp_path / 'dataset'))
+    saved_dataset = ctd.VariableLengthDataset.from_saved(
+        str(tmp_path / 'dataset')
+    )
+    assert_same_batches(all_batches(saved_dataset), batches)
+    for offsets_dataset in [dataset, flat_dataset, saved_dataset]:
+        assert isinstance(offsets_dataset.offsets, np.ndarray)
+        assert offsets_dataset.offsets.dtype == np.int64
+    assert all(type(length) == int for length in saved_dataset[0][1])
+    assert saved_dataset.sort_pmt == list(dataset.sort_pmt)
+    assert saved_dataset.unsort_pmt == list(dataset.unsort_pmt)
+
+
+def test_dataset_dtype(sequences):
+    dataset = ctd.VariableLengthDataset(sequences, 4, 0, dtype=torch.int16)
+    tensor, _ = dataset[0]
+    assert tensor.dtype == torch.int16
+
+    with pytest.raises(ValueError):
+        ctd.VariableLengthDataset([[1, 40000]], 1, 0, dtype=torch.int16)
+    with pytest.raises(ValueError):
+        ctd.VariableLengthDataset([[1, 2]], 1, -40000, dtype=torch.int16)
+
+
+def test_dataset_return_packed_sequence(sequences):
+    dataset = ctd.VariableLengthDataset(sequences, 4, 0)
+    packed_dataset = ctd.VariableLengthDataset(
+        sequences, 4, 0, return_packed_sequence=True
+    )
+    tensor, lengths = dataset[0]
+    packed, packed_lengths = packed_dataset[0]
+    assert isinstance(packed, torch.nn.utils.rnn.PackedSequence)
+    assert packed_lengths == lengths
+    unpacked, _ = torch.nn.utils.rnn.pad_packed_sequence(packed)
+    assert torch.equal(unpacked, tensor[:max(lengths)])
+
+
+def reference_pad_and_batch(data, batch_size, padding_value, shuffle_pmt=None):
+    """Pad, transpose, and shuffle the sorted data through the full tensor"""
+    sort_pmt, _ = ctf.sort_unsort_pmts([len(line) for line in data], True)
+    padded = torch.nn.utils.rnn.pad_sequence(
+        [torch.tensor(data[i]) for i in sort_pmt], padding_value=padding_value
+    )
+    tensor = padded.t().reshape(-1, batch_size, padded.size(0)).transpose(1, 2)
+    if shuffle_pmt is not None:
+        tensor = tensor[shuffle_pmt]
+    return tensor
+
+
+def test_pad_and_batch(sequences):
+    data_set = ctf.pad_and_batch(sequences, 4, -1, gradient_accumulation=2)
+    # 50 sequences fill 6 full batches of 8, split into 12 batches of 4
+    tensor = data_set['tensor']
+    assert tensor.shape == (12, max(map(len, sequences[:48])), 4)
+    assert torch.equal(tensor, reference_pad_and_batch(sequences[:48], 4, -1))
+    lengths = data_set['lengths']
+    assert lengths.shape == (12, 4)
+    sort_pmt = data_set['sort_pmt']
+    assert lengths.ravel().tolist() == [len(sequences[i]) for i in sort_pmt]
+    assert [sort_pmt[i] for i in data_set['unsort_pmt']] == list(range(48))
+    assert 'batch_shuffle_pmt' not in data_set
+
+
+def test_pad_and_batch_shuffled(sequences):
+    random.seed(0)
+    data_set = ctf.pad_and_batch(sequences, 4, -1, batch_shuffling='batch')
+    shuffle_pmt = data_set['batch_shuffle_pmt']
+    unshuffle_pmt = data_set['batch_unshuffle_pmt']
+    assert sorted(shuffle_pmt) == list(range(12))
+    assert shuffle_pmt != list(range(12))
+    assert [shuffle_pmt[i] for i in unshuffle_pmt] == list(range(12))
+    # Sorted batch `b` lands at position `unshuffle_pmt[b]`
+    sorted_set = ctf.pad_and_batch(sequences, 4, -1)
+    tensor = data_set['tensor']
+    for batch in range(12):
+        assert torch.equal(
+            tensor[unshuffle_pmt[batch]], sorted_set['tensor'][batch]
+        )
+    assert torch.equal(
+        tensor, reference_pad_and_batch(sequences[:48], 4, -1, shuffle_pmt)
+    )
+    lengths = data_set['lengths']
+    assert lengths.ndim == 2
+    assert np.array_equal(lengths, sorted_set['lengths'][shuffle_pmt])
+    random.seed(0)
+    reseeded = ctf.pad_and_batch(sequences, 4, -1, batch_shuffling='batch')
+    assert reseeded['batch_shuffle_pmt'] == shuffle_pmt
+
+
+def test_pad_and_batch_packed(sequences):
+    random.seed(1)
+    data_set = ctf.pad_and_batch(
+        sequences, 4, -1, batch_shuffling='batch', pack=True
+    )
+    tensor = data_set['tensor']
+    lengths = data_set['lengths']
+    packed = data_set['packed'].unbind()
+    cu_seqlens = data_set['cu_seqlens']
+    assert cu_seqlens.dtype == torch.int32
+    assert cu_seqlens.tolist() == [0] + np.cumsum(lengths.ravel()).tolist()
+    # Packed sequences follow the shuffled batch order, column by column
+    assert len(packed) == 48
+    for i, line in enumerate(packed):
+        batch, column = divmod(i, 4)
+        length = lengths[batch, column]
+        assert len(line) == length
+        assert torch.equal(line, tensor[batch, :length, column])
+        start, end = cu_seqlens[i:i + 2].tolist()
+        assert end - start == length
+    sort_pmt = data_set['sort_pmt']
+    shuffle_pmt = data_set['batch_shuffle_pmt']
+    first = sort_pmt[shuffle_pmt[0] * 4]
+    assert packed[0].tolist() == sequences[first]
+
+
+@pytest.fixture(scope='module')
+def boundary_sequences():
+    # Sorted by descending length, these are sequences 1, 4, 0, 3, 5, 2, 6 with
+    # lengths 6, 5, 2, 2, 2, 1, 1
+    lengths = [2, 6, 1, 2, 5, 2, 1]
+    return [[i] * length for i, length in enumerate(lengths)]
+
+
+@pytest.mark.parametrize(
+    'strategy, expected',
+    [
+        ('split', [[6, 5], [2, 2, 2], [1, 1]]),
+        ('soft_drop', [[2, 2, 2], [1, 1]]),
+        ('hard_drop', [[2, 2, 1], [1]]),
+    ]
+)
+def test_dataset_max_padding(boundary_sequences, strategy, expected):
+    # The batch starting at the length-6 sequence would pad the third sequence
+    # by 4, so it must end before the first length-2 sequence
+    dataset = ctd.VariableLengthDataset(
+        boundary_sequences,
+        3,
+        0,
+        max_padding=2,
+        max_pad_strategy=strategy
+    )
+    assert [dataset[i][1] for i in range(len(dataset))] == expected
+    sequence_ids = [dataset[i][0][0].tolist() for i in range(len(dataset))]
+    expected_ids = {
+        'split': [[1, 4], [0, 3, 5], [2, 6]],
+        'soft_drop': [[0, 3, 5], [2, 6]],
+        'hard_drop': [[3, 5, 2], [6]],
+    }
+    assert sequence_ids == expected_ids[strategy]
+
+
+def test_dataset_batch_by_tokens(boundary_sequences):
+    dataset = ctd.VariableLengthDataset(
+        boundary_sequences, 6, 0, batch_by='tokens'
+    )
+    assert [list(batch) for batch in dataset.batches] == [
+        [0], [1], [2, 3, 4], [5, 6]
+    ]
+    assert [dataset[i][1] for i in range(len(dataset))] == [
+        [6], [5], [2, 2, 2], [1, 1]
+    ]
+    assert dataset.total_num_instances == 7
+
+    dataset = ctd.VariableLengthDataset(
+        boundary_sequences,
+        6,
+        0,
+        batch_by='tokens',
+        gradient_accumulation=3,
+        drop_final=True
+    )
+    assert [list(batch) for batch in dataset.batches] == [[0], [1], [2, 3, 4]]
+    assert dataset.total_num_instances == 5
+
+    # With 10 tokens, the length-5 sequence would be batched with a length-2
+    # sequence, so it is dropped
+    dataset = ctd.VariableLengthDataset(
+        boundary_sequences, 10, 0, batch_by='tokens', max_padding=2
+    )
+    assert [dataset[i][1] for i in range(len(dataset))] == [
+        [6], [2, 2, 2, 1, 1]
+    ]
+
+
+def test_import_embeddings(tmp_path):
+    embeddings = np.arange(12, dtype=np.float64).reshape(4, 3)
+    np.save(tmp_path / 'emb.npy', embeddings)
+    with open(tmp_path / 'emb_indices.json', 'w') as f:
+        json.dump({'a': 2, 'b': 0, 'z': 3}, f)
+    vocab = wr.Vocab([['b', 'c', 'a', 'd']])
+    assert vocab.id_to_tok == ['<unk>', 'b', 'c', 'a', 'd']
+
+    imported = ctf.import_embeddings(
+        str(tmp_path / 'emb'),
+        vocab,
+        init_range=0.5,
+        rng=np.random.default_rng(0)
+    )
+    assert imported.shape == (5, 3)
+    assert np.array_equal(imported[1], embeddings[0])
+    assert np.array_equal(imported[3], embeddings[2])
+    missing = imported[[0, 2, 4]]
+    assert np.all((missing >= -0.5) & (missing < 0.5))
+
+    # The same seed gives the same missing rows, and the indices path can be
+    # given separately
+    reimported = ctf.import_embeddings(
+        str(tmp_path / 'emb'),
+        vocab,
+        indices_path=str(tmp_path / 'emb_indices.json'),
+        init_range=0.5,
+        rng=np.random.default_rng(0)
+    )
+    assert np.array_equal(reimported, imported)
+    other_seed = ctf.import_embeddings(
+        str(tmp_path / 'emb'), vocab, rng=np.random.default_rng(1)
+    )
+    assert not np.array_equal(other_seed[[0, 2, 4]], missing)
+    assert np.array_equal(other_seed[[1, 3]], imported[[1, 3]])
@@ -0,0 +1,111 @@
+import itertools
+import pytest
+import numpy as np
+from chonker import compute as cp
+
+
+def reference_viterbi(transitions, mode='max', length=None):
+    """The position-by-position recursion over all previous positions"""
+    seq_length = length or transitions.shape[0]
+    select = max if mode == 'max' else min
+    scores = [0.0]
+    back = [-1]
+    for position in range(1, seq_length + 1):
+        candidates = [
+            transitions[previous, position - 1] + scores[previous]
+            for previous in range(position)
+        ]
+        best = select(candidates)
+        scores.append(best)
+        back.append(candidates.index(best))
+    path = []
+    position = seq_length
+    while position > 0:
+        path.append((back[position], position))
+        position = back[position]
+    path.reverse()
+    return path, scores[seq_length]
+
+
+def brute_force_viterbi(transitions, mode='max'):
+    """Score every path from position 0 to the final position"""
+    seq_length = transitions.shape[0]
+    paths = []
+    for num_stops in range(seq_length):
+        for stops in itertools.combinations(range(1, seq_length), num_stops):
+            positions = (0, ) + stops + (seq_length, )
+            path = list(zip(positions, positions[1:]))
+            score = sum(transitions[i, j - 1] for i, j in path)
+            paths.append((score, path))
+    select = max if mode == 'max' else min
+    score, path = select(paths, key=lambda item: item[0])
+    return path, score
+
+
+def random_transitions(rng, seq_length, mode='max'):
+    """A random acyclic transition matrix, with backward transitions excluded"""
+    transitions = rng.normal(size=(seq_length, seq_length))
+    excluded = -np.inf if mode == 'max' else np.inf
+    transitions[np.tril_indices(seq_length, -1)] = excluded
+    return transitions
+
+
+@pytest.fixture(params=['jit', 'numpy'])
+def scan_backend(request, monkeypatch):
+    """Run each test with the compiled scan (if available) and without it"""
+    if request.param == 'numpy':
+        monkeypatch.setattr(cp, '_compiled_viterbi_scan', lambda: None)
+    return request.param
+
+
+@pytest.mark.parametrize('mode', ['max', 'min'])
+def test_acyclic_viterbi_brute_force(scan_backend, mode):
+    rng = np.random.default_rng(0)
+    for seq_length in range(1, 9):
+        transitions = random_transitions(rng, seq_length, mode)
+        path, score = cp.acyclic_viterbi(transitions, mode=mode)
+        gold_path, gold_score = brute_force_viterbi(transitions, mode=mode)
+        assert path == gold_path
+        assert score == pytest.approx(gold_score)
+
+
+@pytest.mark.parametrize('mode', ['max', 'min'])
+@pytest.mark.parametrize('seq_length', [63, 64, 65, 129])
+def test_acyclic_viterbi_block_boundaries(scan_backend, mode, seq_length):
+    rng = np.random.default_rng(seq_length)
+    transitions = random_transitions(rng, seq_length, mode)
+    for length in [None, seq_length - 1, 1]:
+        path, score = cp.acyclic_viterbi(transitions, mode=mode, length=length)
+        gold_path, gold_score = reference_viterbi(
+            transitions, mode=mode, length=length
+        )
+        assert path == gold_path
+        assert score == pytest.approx(gold_score)
+
+
+def test_acyclic_viterbi_ties(scan_backend):
+    # Ties are broken in favor of the earliest previous position
+    transitions = np.zeros((70, 70))
+    path, score = cp.acyclic_viterbi(transitions)
+    assert path == [(0, 70)]
+    assert score == 0.0
+
+
+def test_acyclic_viterbi_float32(scan_backend):
+    rng = np.random.default_rng(1)
+    transitions = random_transitions(rng, 65)
+    path, score = cp.acyclic_viterbi(transitions.astype(np.float32))
+    assert score.dtype == np.float32
+    assert path == reference_viterbi(transitions)[0]
+
+    _, score = cp.acyclic_viterbi(transitions, dtype=np.float32)
+    assert score.dtype == np.float32
+    with pytest.warns(UserWarning):
+        cp.acyclic_viterbi(np.full((3, 3), 1e300), dtype=np.float32)
+
+
+def test_acyclic_viterbi_errors():
+    with pytest.raises(ValueError):
+        cp.acyclic_viterbi(np.zeros((2, 2)), mode='avg')
+    with pytest.raises(ValueError):
+        cp.acyclic_viterbi(np.zeros((2, 2)), dtype=np.int32)
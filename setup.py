@@ -22,5 +22,6 @@ setuptools.setup(
         "numpy",
         "pyyaml",
         "torch"
-    ]
+    ],
+    extras_require={"jit": ["numba"], "msgpack": ["msgpack"]}
 )
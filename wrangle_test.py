@@ -1,9 +1,16 @@
 import pytest
 import copy
 import os
+import re
+import numpy as np
 from chonker import wrangle as wr
 
-lines = wr.get_lines('test/test_lines.txt')
+
+@pytest.fixture(scope='module')
+def lines():
+    return wr.get_lines('test/test_lines.txt')
+
+
 char_line_raw = 'Thisisastringofcharacters'
 space_line_raw = 'These words  are <TAG> separated by spaces'
 tab_line_raw = 'These\twords\tare\ttab\tdelimited'
@@ -18,46 +25,91 @@ tag_line_split = [
 ]
 
 
-def test_get_lines():
+def test_get_lines(lines):
     assert lines[0] == char_line_raw
     assert lines[1] == space_line_raw
     assert lines[2] == tab_line_raw
 
 
-ws_split_lines = wr.split_lines(lines)
-space_split_lines = wr.split_lines(lines, delimiter=r'\ +')
-tab_split_lines = wr.split_lines(lines, delimiter=r'\t+')
+def test_iter_lines(lines):
+    assert list(wr.iter_lines('test/test_lines.txt')) == lines
+
+
+@pytest.fixture(scope='module')
+def ws_split_lines(lines):
+    return wr.split_lines(lines)
+
+
+@pytest.fixture(scope='module')
+def space_split_lines(lines):
+    return wr.split_lines(lines, delimiter=r'\ +')
+
+
+@pytest.fixture(scope='module')
+def tab_split_lines(lines):
+    return wr.split_lines(lines, delimiter=r'\t+')
 
 
-def test_ws_split_lines():
+def test_ws_split_lines(ws_split_lines):
     assert ws_split_lines[0] == [char_line_raw]
     assert ws_split_lines[1] == space_line_split
     assert ws_split_lines[2] == tab_line_split
 
 
-def test_space_split_lines():
+def test_space_split_lines(space_split_lines):
     assert space_split_lines[0] == [char_line_raw]
     assert space_split_lines[1] == space_line_split
     assert space_split_lines[2] == [tab_line_raw]
 
 
-def test_tab_split_lines():
+def test_tab_split_lines(tab_split_lines):
     assert tab_split_lines[0] == [char_line_raw]
     assert tab_split_lines[1] == [space_line_raw]
     assert tab_split_lines[2] == tab_line_split
 
 
-flattened_matrix = wr.flatten(ws_split_lines)
+edge_lines = [
+    'a b  c', ' a b', 'a b ', '  a  b  ', ' ', '   ', '', 'abc', 'a\tb \t c',
+    '12 a34b5', 'aab ba\n'
+]
+
+
+@pytest.mark.parametrize('delimiter', [r'\ +', r'\t+', 'a+', r'\.+'])
+def test_split_lines_literal(delimiter):
+    lines = edge_lines + ['..a...b.', '.', '...']
+    assert wr.split_lines(lines, delimiter=delimiter) == [
+        re.split(delimiter, line) for line in lines
+    ]
+
+
+@pytest.mark.parametrize('delimiter', [r'\s+', r'\d+', '[ab]+'])
+def test_split_lines_regex(delimiter):
+    expected = [re.split(delimiter, line) for line in edge_lines]
+    assert wr.split_lines(edge_lines, delimiter=delimiter) == expected
+    assert wr.split_lines(
+        edge_lines, delimiter=re.compile(delimiter)
+    ) == expected
+
+
+@pytest.fixture(scope='module')
+def flattened_matrix(ws_split_lines):
+    return wr.flatten(ws_split_lines)
+
+
 concat_lines = [
     char_line_raw
 ] + space_line_split + tab_line_split + tag_line_split
 
 
-def test_flatten():
+def test_flatten(flattened_matrix):
     assert flattened_matrix == concat_lines
 
 
-basic_tokenized_text = wr.basic_tokenize('test/test_lines.txt')
+@pytest.fixture(scope='module')
+def basic_tokenized_text():
+    return wr.basic_tokenize('test/test_lines.txt')
+
+
 char_line_tok = ['thisisastringofcharacters']
 space_line_tok = ['these', 'words', 'are', '<tag>', 'separated', 'by', 'spaces']
 tab_line_tok = ['these', 'words', 'are', 'tab', 'delimited']
@@ -70,26 +122,32 @@ gold_basic_tokenized_text = [
 ]
 
 
-def test_basic_tokenize():
+def test_basic_tokenize(basic_tokenized_text):
     assert basic_tokenized_text == [
         char_line_tok, space_line_tok, tab_line_tok, tag_line_tok
     ]
 
 
-basic_tokenized_with_edges = wr.basic_tokenize(
-    'test/test_lines.txt', edge_tokens=True
-)
+@pytest.fixture(scope='module')
+def basic_tokenized_with_edges():
+    return wr.basic_tokenize('test/test_lines.txt', edge_tokens=True)
+
+
 tok_target_with_edges = [
     ['<bos>'] + line + ['<eos>']
     for line in [char_line_tok, space_line_tok, tab_line_tok, tag_line_tok]
 ]
 
 
-def test_tokenize_with_edges():
+def test_tokenize_with_edges(basic_tokenized_with_edges):
     assert basic_tokenized_with_edges == tok_target_with_edges
 
 
-character_tokenized_text = wr.character_tokenize('test/test_lines.txt')
+@pytest.fixture(scope='module')
+def character_tokenized_text():
+    return wr.character_tokenize('test/test_lines.txt')
+
+
 char_line_chars = [char for char in 'thisisastringofcharacters']
 space_line_chars = [char for char in ''.join(space_line_tok[:3])]
 space_line_chars += ['<tag>'] + [char for char in ''.join(space_line_tok[4:])]
@@ -100,16 +158,21 @@ tag_line_chars = [
 ]
 tab_line_chars = [char for char in ''.join(tab_line_tok)]
 
-character_tokenized_no_tags = wr.character_tokenize(
-    'test/test_lines.txt', preserve_tags=False
-)
+
+@pytest.fixture(scope='module')
+def character_tokenized_no_tags():
+    return wr.character_tokenize('test/test_lines.txt', preserve_tags=False)
+
+
 space_line_chars_no_tags = (
     [char for char in ''.join(space_line_tok[:3])] + 
     ['<', 't', 'a', 'g', '>'] +
     [char for char in ''.join(space_line_tok[4:])]
 )
 
-def test_character_tokenize():
+def test_character_tokenize(
+    character_tokenized_text, character_tokenized_no_tags
+):
     assert character_tokenized_text[0] == char_line_chars
     assert character_tokenized_text[1] == space_line_chars
     assert character_tokenized_text[2] == tab_line_chars
@@ -117,6 +180,39 @@ def test_character_tokenize():
     assert character_tokenized_no_tags[1] == space_line_chars_no_tags
 
 
+def test_tokenize_cache():
+    with open('test/test_cache_lines.txt', 'w') as f:
+        print(space_line_raw, file=f)
+    text = wr.basic_tokenize('test/test_cache_lines.txt', cache=True)
+    assert text == [space_line_tok]
+    text[0].append('extra')
+    text = wr.basic_tokenize('test/test_cache_lines.txt', cache=True)
+    assert text == [space_line_tok]
+
+    with open('test/test_cache_lines.txt', 'a') as f:
+        print(tab_line_raw, file=f)
+    text = wr.basic_tokenize('test/test_cache_lines.txt', cache=True)
+    assert text == [space_line_tok, tab_line_tok]
+
+    wr.clear_cache()
+    text = wr.character_tokenize('test/test_cache_lines.txt', cache=True)
+    assert text[1] == tab_line_chars
+
+    os.remove('test/test_cache_lines.txt')
+
+
+def test_tokenize_lowercase_tags():
+    # The Kelvin sign lowercases to an ASCII `k` only after tags are split
+    with open('test/test_case_lines.txt', 'w', encoding='utf-8') as f:
+        print('a<\u212a>b <TAG>', file=f)
+    text = wr.basic_tokenize('test/test_case_lines.txt', split_tags=True)
+    assert text == [['a<k>b', '<tag>']]
+    text = wr.character_tokenize('test/test_case_lines.txt')
+    assert text == [['a', '<', 'k', '>', 'b', '<tag>']]
+
+    os.remove('test/test_case_lines.txt')
+
+
 chars_from_space_line = [
     ['t', 'h', 'e', 's', 'e'], ['w', 'o', 'r', 'd', 's'], ['a', 'r', 'e'],
     ['<tag>']
@@ -125,9 +221,14 @@ chars_from_space_line = [
 
 def test_chars_from_words():
     assert wr.chars_from_words(space_line_tok[:4]) == chars_from_space_line
+    words = iter(space_line_tok[:3])
+    assert wr.chars_from_words(words) == chars_from_space_line[:3]
+
 
+@pytest.fixture(scope='module')
+def ngram_data():
+    return wr.get_ngrams(gold_basic_tokenized_text, 2)
 
-ngram_data = wr.get_ngrams(gold_basic_tokenized_text, 2)
 
 ngram_counts = {
     ('thisisastringofcharacters', ): 1,
@@ -235,19 +336,23 @@ id_to_ngram = {
 }
 
 
-def test_ngram_counts():
+def test_ngram_counts(ngram_data):
     assert ngram_counts == ngram_data[0]
 
 
-def test_ngram_to_id():
+def test_ngram_to_id(ngram_data):
     assert ngram_to_id == ngram_data[1][0]
 
 
-def test_id_to_ngram():
+def test_id_to_ngram(ngram_data):
     assert id_to_ngram == ngram_data[1][1]
 
 
-vocab = wr.Vocab(basic_tokenized_text)
+@pytest.fixture(scope='module')
+def vocab(basic_tokenized_text):
+    return wr.Vocab(basic_tokenized_text)
+
+
 tok_to_id_1 = {
     '<unk>': 0,
     'thisisastringofcharacters': 1,
@@ -268,34 +373,34 @@ tok_to_id_1 = {
     '1<punc>2': 16,
     '<cur>8<punc><punc><punc>': 17
 }
-id_to_tok_1 = {
-    0: '<unk>',
-    1: 'thisisastringofcharacters',
-    2: 'these',
-    3: 'words',
-    4: 'are',
-    5: '<tag>',
-    6: 'separated',
-    7: 'by',
-    8: 'spaces',
-    9: 'tab',
-    10: 'delimited',
-    11: '<punc>these',
-    12: '<punc>edge',
-    13: 'cases',
-    14: 'for',
-    15: 'tags<punc>',
-    16: '1<punc>2',
-    17: '<cur>8<punc><punc><punc>'
-}
+id_to_tok_1 = [
+    '<unk>',
+    'thisisastringofcharacters',
+    'these',
+    'words',
+    'are',
+    '<tag>',
+    'separated',
+    'by',
+    'spaces',
+    'tab',
+    'delimited',
+    '<punc>these',
+    '<punc>edge',
+    'cases',
+    'for',
+    'tags<punc>',
+    '1<punc>2',
+    '<cur>8<punc><punc><punc>'
+]
 
 
-def test_vocab_init():
+def test_vocab_init(vocab):
     assert vocab.tok_to_id == tok_to_id_1
     assert vocab.id_to_tok == id_to_tok_1
 
 
-def test_vocab_add_vocab():
+def test_vocab_add_vocab(vocab):
     voc = copy.deepcopy(vocab)
     voc.add_vocab('cat')
     voc.add_vocab(['kitty', 'cat'])
@@ -306,34 +411,92 @@ def test_vocab_add_vocab():
     assert len(voc.tok_to_id) == len(voc.id_to_tok) == 20
 
 
+def test_vocab_clone(vocab):
+    voc = vocab.clone()
+    voc.add_vocab('cat')
+    assert vocab.tok_to_id == tok_to_id_1
+    assert vocab.id_to_tok == id_to_tok_1
+    assert voc.to_ids('cat') == [18]
+    assert copy.deepcopy(voc).tok_to_id == voc.tok_to_id
+
+    voc.extra = []
+    voc_copy = copy.deepcopy(voc)
+    voc_copy.extra.append('cat')
+    voc_copy.add_vocab('kitty')
+    assert voc.extra == []
+    assert voc.size() == 19
+
+
 new_source = [['this', 'is', 'a', 'cat'], ['these', 'are', 'cats']]
 
 
-def test_vocab_reset():
+def test_vocab_source_added(vocab):
+    voc = vocab.source_added(new_source)
+    assert vocab.tok_to_id == tok_to_id_1
+    assert vocab.id_to_tok == id_to_tok_1
+    new_ids = voc.to_ids(['this', 'is', 'a', 'cat', 'cats'])
+    assert new_ids == [18, 19, 20, 21, 22]
+    assert voc.to_ids('these') == [2]
+    assert voc.size() == 23
+
+
+def test_vocab_reset(vocab):
     voc = copy.deepcopy(vocab)
     voc.reset()
     assert len(voc.tok_to_id) == len(voc.id_to_tok) == 0
 
 
-def test_vocab_size():
+def test_vocab_size(vocab):
     assert vocab.size() == len(vocab.tok_to_id) == len(vocab.id_to_tok)
 
 
-def test_vocab_to_ids():
+def test_vocab_to_ids(vocab):
     assert vocab.to_ids('<tag>') == [5]
     assert vocab.to_ids(['these', 'are', 'spaces']) == [2, 4, 8]
     assert vocab.to_ids(['these', 'are', 'cats']) == [2, 4, 0]
 
 
-def test_vocab_to_tokens():
+def test_vocab_to_ids_array(vocab):
+    assert vocab.to_ids_array('<tag>').tolist() == [5]
+    ids = vocab.to_ids_array(['these', 'are', 'cats'])
+    assert ids.dtype == np.int32
+    assert ids.tolist() == [2, 4, 0]
+
+
+def test_vocab_to_ids_batch(vocab):
+    ids = vocab.to_ids_batch(new_source + [[]] + gold_basic_tokenized_text)
+    assert [line.tolist() for line in ids] == (
+        [vocab.to_ids(line) for line in new_source] + [[]] +
+        [vocab.to_ids(line) for line in gold_basic_tokenized_text]
+    )
+    assert vocab.to_ids_batch([]) == []
+
+
+def test_vocab_to_tokens(vocab):
     assert vocab.to_tokens(5) == ['<tag>']
     assert vocab.to_tokens([2, 4, 8]) == ['these', 'are', 'spaces']
     cat_sent = ['these', 'are', 'cats']
     inv_cat_sent = ['these', 'are', '<unk>']
     assert vocab.to_tokens(vocab.to_ids(cat_sent)) == inv_cat_sent
+    assert vocab.to_tokens([-1, 18]) == ['<unk>', '<unk>']
 
 
-def test_vocab_save_load():
+def test_vocab_ngrams(vocab):
+    id_text = [vocab.to_ids(line) for line in gold_basic_tokenized_text]
+    id_ngram_data = wr.get_ngrams(gold_basic_tokenized_text, 2, vocab=vocab)
+    assert id_ngram_data == wr.get_ngrams(id_text, 2)
+    assert list(id_ngram_data[0].values()) == list(ngram_counts.values())
+    # Both paths agree on lengths of only 2, and reject lengths below 1
+    assert wr.get_ngrams(
+        gold_basic_tokenized_text, 2, min_length=2, vocab=vocab
+    ) == wr.get_ngrams(id_text, 2, min_length=2)
+    with pytest.raises(ValueError):
+        wr.get_ngrams(id_text, 2, min_length=0)
+    with pytest.raises(ValueError):
+        wr.get_ngrams(gold_basic_tokenized_text, 2, min_length=0, vocab=vocab)
+
+
+def test_vocab_save_load(vocab):
     voc_1 = copy.deepcopy(vocab)
     voc_2 = wr.Vocab(unk_token='<u>')
 
@@ -347,3 +510,48 @@ def test_vocab_save_load():
     assert voc_1.id_to_tok == voc_2.id_to_tok == vocab.id_to_tok
 
     os.remove('test/test_vocab.yaml')
+
+
+def test_vocab_save_load_json(vocab):
+    vocab.save('test/test_vocab.json')
+    voc = wr.Vocab.from_saved('test/test_vocab.json')
+    assert voc.tok_to_id == vocab.tok_to_id
+    assert voc.id_to_tok == vocab.id_to_tok
+    assert voc.unk_token == vocab.unk_token
+    assert voc.unk_id == vocab.unk_id
+
+    os.remove('test/test_vocab.json')
+
+
+def test_vocab_save_load_txt(vocab):
+    voc_1 = vocab.source_added([['', 'with\ttab', 'with\rreturn']])
+    voc_1.save_txt('test/test_vocab.txt')
+    voc_2 = wr.Vocab(unk_token='<u>')
+    voc_2.load_txt('test/test_vocab.txt')
+    assert voc_2.tok_to_id == voc_1.tok_to_id
+    assert voc_2.id_to_tok == voc_1.id_to_tok
+    assert voc_2.unk_token == voc_1.unk_token
+    assert voc_2.unk_id == voc_1.unk_id
+
+    voc_1.add_vocab('with\nnewline')
+    with pytest.raises(ValueError):
+        voc_1.save_txt('test/test_vocab.txt')
+    with open('test/test_vocab.txt', 'w') as f:
+        f.write('<u>\na\nb')
+    voc_2.load_txt('test/test_vocab.txt')
+    assert voc_2.id_to_tok == ['<u>', 'a', 'b']
+    assert voc_2.unk_token == '<u>'
+    with open('test/test_vocab.txt', 'w') as f:
+        f.write('<u>')
+    voc_2.load_txt('test/test_vocab.txt')
+    assert voc_2.id_to_tok == ['<u>']
+
+    voc_1.reset()
+    with pytest.raises(ValueError):
+        voc_1.save_txt('test/test_vocab.txt')
+    open('test/test_vocab.txt', 'w').close()
+    with pytest.raises(ValueError):
+        voc_2.load_txt('test/test_vocab.txt')
+    assert voc_2.id_to_tok == ['<u>']
+
+    os.remove('test/test_vocab.txt')